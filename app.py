@@ -6,15 +6,21 @@ from flask import (
     redirect,
     flash,
     url_for,
+    g,
+    Response,
+    stream_with_context,
 )
 from flask_cors import CORS
 import requests
-import os
 from os import urandom
 from main import PolicyQuestion
+from assessment import assess_claim, claimant_details, iter_sections
+import jobs
+import metrics
+import workspace
 from collections import defaultdict
 from werkzeug.datastructures import ImmutableMultiDict
-from datetime import datetime
+from werkzeug.utils import secure_filename
 import time
 import json
 
@@ -24,6 +30,29 @@ CORS(app)
 # MySQL Configuration
 app.config["SECRET_KEY"] = urandom(24)
 
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def record_duration(response):
+    if "start" in g:
+        metrics.observe(
+            "route_duration_seconds",
+            time.perf_counter() - g.start,
+            route=request.url_rule.rule if request.url_rule else "unknown",
+            method=request.method,
+            status=response.status_code,
+        )
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/")
 def index():
     return redirect(url_for("login"))
@@ -102,26 +131,16 @@ def policy_coverage():
 
             print("=======================================")
             print(result)
-            start_data = result["start-date"]
-            disease = result["disease"]
-            first_diagnosis = result["diagnose-date"]
-            drink_smoke = result["drink-smoke"]
-
-            additional_data = f""" the User has provided the following data:
-            start date of policy: {start_data}
-            whether any ongoing disease : {disease}
-            When was ongoing disease first diagnosed: {first_diagnosis}
-            Do you drink or smoke? {drink_smoke}
-            today's date: {datetime.now().strftime("%Y-%m-%d")}
-            """
+            additional_data = claimant_details(result)
             print("=======================================")
             print(additional_data)
-            os.makedirs(f"static/{user}", exist_ok=True)
-            file.save(f"static/{user}_{file.filename}")
+            path = workspace.save_upload(
+                file, f"static/{user}/{secure_filename(file.filename)}", user
+            )
             # Process the File
             user_obj = PolicyQuestion(user)
             response = user_obj.get_policy_details(
-                f"static/{user}_{file.filename}", additional_data=additional_data
+                path, additional_data=additional_data
             )
             # Get answers from the File
 
@@ -149,71 +168,54 @@ def policy_coverage():
     return render_template("policy_coverage.html", success=False)
 
 
+def _claim_request(data: ImmutableMultiDict):
+    """
+    Validate a submitted claim form and build the details passed to the LLM.
+
+    Returns the user, their PolicyQuestion object and the additional data.
+    """
+
+    print("=======================================")
+    print(data)
+    print("=======================================")
+    user = data.get("user")
+    docs = json.loads(data.get("docs"))
+    running = jobs.pending(user)
+    if running:
+        raise Exception("Documents are still being processed: {}. Please try again in a moment.".format(", ".join(job["document"] for job in running)))
+    if "policy" not in docs or "discharge" not in docs or "bills" not in docs:
+        raise Exception("Please Upload all neccessary documents like Policy, Discharge and Bills. Currently uploaded: {}".format(", ".join(docs)))
+    user_obj = PolicyQuestion(user)
+    result = defaultdict(list)
+    for key, value in data.items(multi=True):
+        result[key].append(value)
+
+    print("=======================================")
+    print(result)
+    return user, user_obj, claimant_details(result)
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
 @app.route("/claim-assessment", methods=["GET", "POST"])
 def claim_assessment():
     if request.method == "POST":
         try:
             data = request.form
-            print("=======================================")
-            print(data)
-            print("=======================================")
-            user = data.get("user")
-            docs = json.loads(data.get("docs"))
-            if "policy" not in docs or "discharge" not in docs or "bills" not in docs:
-                raise Exception("Please Upload all neccessary documents like Policy, Discharge and Bills. Currently uploaded: {}".format(", ".join(docs)))
-            user_obj = PolicyQuestion(user)
-            result = defaultdict(list)
-            for key, value in data.items(multi=True):
-                result[key].append(value)
-
-            print("=======================================")
-            print(result)
-            start_data = result["start-date"]
-            disease = result["disease"]
-            first_diagnosis = result["diagnose-date"]
-            drink_smoke = result["drink-smoke"]
-
-            additional_data = f""" the User has provided the following data:
-            start date of policy: {start_data}
-            whether any ongoing disease : {disease}
-            When was ongoing disease first diagnosed: {first_diagnosis}
-            Do you drink or smoke? {drink_smoke}
-            today's date: {datetime.now().strftime("%Y-%m-%d")}
-            """
-            policy_response = user_obj.get_policy_details(f"static/docs/{user}/policy.pdf", additional_data=additional_data)
-            bill_response = user_obj.get_bill_details()
-            discharge_response = user_obj.get_discharge_details(path=f"static/docs/{user}/discharge.pdf")
-
-            doc_lst = os.listdir(f"static/docs/{user}/")
-            lst= [data,
-                policy_response,
-                bill_response,
-                discharge_response ]
-            if len(doc_lst) > 3:
-                
-                for i in doc_lst:
-                    if "reports" in i:
-                        report_response = user_obj.get_report_details(
-                            path=f"static/docs/{user}/reports.pdf"
-                        )
-                        lst.append(report_response)
-
-                    if "prescriptions" in i:
-                        prescription_resp = user_obj.get_prescription_details(
-                            file_name="prescriptions",
-                        )
-                        lst.append(prescription_resp)
-                    if "claim" in i:
-                        claim_resp = user_obj.get_claim_details(
-                            file_name="claim",
-                        )
-                        lst.append(claim_resp)
-            # for any other document if uploaded make a question list and call
-            
-            # combine all responses into one dict
-            response = { 
-                k:v for d in lst for k,v in d.items()
-            }
+            user, user_obj, additional_data = _claim_request(data)
+            response, errors = assess_claim(user_obj, user, additional_data)
+            if not response:
+                raise Exception(
+                    "Assessment failed: {}".format(
+                        ", ".join(f"{k}: {v}" for k, v in errors.items())
+                    )
+                )
+            for section, error in errors.items():
+                flash(f"Could not assess {section}: {error}", "warning")
+            # combine the form data with the answers of all sections
+            response = {**data, **response}
 
             return render_template("claim_assessment.html", data=response, success=True)
         except Exception as e:
@@ -222,6 +224,43 @@ def claim_assessment():
             return render_template("claim_assessment.html", success=False, error=str(e))
     return render_template("claim_assessment.html", success=False) 
 
+
+@app.route("/claim-assessment/stream", methods=["POST"])
+def claim_assessment_stream():
+    """
+    Stream the claim assessment as server-sent events.
+
+    The form data is sent first, then every section as soon as it finishes,
+    failed sections as error events and a final done event.
+    """
+
+    data = request.form
+    try:
+        user, user_obj, additional_data = _claim_request(data)
+    except Exception as e:
+        print(e)
+        return jsonify({"error": str(e)}), 400
+
+    @stream_with_context
+    def generate():
+        yield _sse("section", {"section": "form", "data": data.to_dict()})
+        failed = {}
+        for name, result, error in iter_sections(user_obj, user, additional_data):
+            if error is None:
+                yield _sse("section", {"section": name, "data": result})
+            else:
+                failed[name] = error
+                yield _sse("error", {"section": name, "error": error})
+        yield _sse("done", {"errors": failed})
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        # keep proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/doc/<document>", methods=["POST"])
 def doc(document):
     if request.method == "POST":
@@ -233,36 +272,34 @@ def doc(document):
             print(file.filename)
             print(user)
             print("=====================================")
-            os.makedirs(f"static/docs/{user}", exist_ok=True)
-
-            file.save(
-                f'static/docs/{user}/{document}.{file.filename.split(".")[-1]}'
+            path = workspace.save_upload(
+                file, f'static/docs/{user}/{document}.{file.filename.split(".")[-1]}', user
             )
-            if document == "policy" or document == "discharge":
-                time.sleep(3)
-                flash(f"{document.upper()} Uploaded Successfully", "success")
-                return redirect(url_for("claim_assessment"))
-            user_obj = PolicyQuestion(user)
-            if document == "reports":
-                user_obj.read_ocr(
-                    f'static/docs/{user}/{document}.{file.filename.split(".")[-1]}',
-                    file_name=document,
 
-                )
-                flash(f"{document.upper()} Uploaded Successfully", "success")
-                return redirect(url_for("claim_assessment"))
-            user_obj.load_doc(
-                f'static/docs/{user}/{document}.{file.filename.split(".")[-1]}',
-                file_name=document,
-            )
+            # the document is processed in the background, the page polls the job
+            job_id = jobs.submit(user, document, path)
+            if request.accept_mimetypes.best == "application/json":
+                return jsonify({"job": job_id, "status": "queued"}), 202
 
-            flash(f"{document.upper()} Uploaded Successfully", "success")
-            return redirect(url_for("claim_assessment"))
+            flash(f"{document.upper()} Uploaded Successfully, processing started", "success")
+            return redirect(url_for("claim_assessment", uploaded=document, job=job_id))
         except Exception as e:
             print(e)
             flash(f"Error in Uploading File\n\n{str(e)}", "danger")
             return redirect(url_for("claim_assessment"))
 
 
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(
+        {k: job[k] for k in ["id", "document", "status", "error", "result"]}
+    )
+
+
 if __name__ == "__main__":
+    metrics.start_flusher()
+    workspace.start_sweeper()
     app.run(debug=True)
@@ -0,0 +1,299 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import cache
+import metrics
+import workspace
+from main import PolicyQuestion
+
+# seconds a single section may take before it is reported as failed
+SECTION_TIMEOUT = int(os.getenv("SECTION_TIMEOUT", "300"))
+
+# ask the policy, bills and discharge sections in one request sharing the policy text
+COMBINED_MODE = os.getenv("COMBINED_MODE", "0") == "1"
+COMBINED_SECTIONS = ["policy", "bills", "discharge"]
+
+# reuse the persisted result of a section while its inputs are unchanged
+SECTION_REUSE = os.getenv("SECTION_REUSE", "1") == "1"
+
+# bump whenever a section prompt changes so persisted results are not reused
+SECTIONS_VERSION = "2"
+
+# documents each section reads, the form details are an input of the policy,
+# the bill reimbursement is checked against the policy document
+SECTION_INPUTS = {
+    "policy": ["static/docs/{user}/policy.pdf"],
+    "bills": ["docs/{user}/bills.txt", "static/docs/{user}/policy.pdf"],
+    "discharge": ["static/docs/{user}/discharge.pdf"],
+    "reports": ["docs/{user}/reports.txt"],
+    "prescriptions": ["docs/{user}/prescriptions.txt"],
+    "claim": ["docs/{user}/claim.txt"],
+}
+
+# guards read-modify-write of the persisted section results
+_sections_lock = threading.Lock()
+
+
+def claimant_details(form: Dict[str, List[str]]) -> str:
+    """
+    Describe the details the user entered in the claim form for the prompts.
+
+    Parameters
+    ----------
+    form : dict
+        Every field of the claim form mapped to the list of its values
+    """
+
+    return f""" the User has provided the following data:
+    start date of policy: {form.get("start-date", [])}
+    whether any ongoing disease : {form.get("disease", [])}
+    When was ongoing disease first diagnosed: {form.get("diagnose-date", [])}
+    Do you drink or smoke? {form.get("drink-smoke", [])}
+    today's date: {datetime.now().strftime("%Y-%m-%d")}
+    """
+
+
+def _sections_path(user: str) -> str:
+    return f"docs/{user}/sections.json"
+
+
+def _read_sections(user: str) -> Dict:
+    try:
+        with open(_sections_path(user), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_section(user: str, name: str, fingerprint: str, result: Dict):
+    with _sections_lock:
+        state = _read_sections(user)
+        state[name] = {"inputs": fingerprint, "result": result}
+        workspace.write_text(_sections_path(user), json.dumps(state))
+
+
+def section_fingerprints(user: str, order: List[str], additional_data: str) -> Dict[str, Optional[str]]:
+    """
+    Hash the inputs of every section.
+
+    A section is fingerprinted by its documents and, for the policy, the
+    form details including today's date, which decides whether waiting
+    periods are over. The bills include the policy document, so replacing
+    the policy also invalidates the bill assessment.
+
+    Parameters
+    ----------
+    user : str
+        User whose uploaded documents are assessed
+    order : List[str]
+        Sections to fingerprint
+    additional_data : str
+        Details provided by the user in the claim form
+
+    Returns
+    -------
+    The fingerprint of every section, None if one of its inputs is missing.
+    """
+
+    def fingerprint(name: str) -> Optional[str]:
+        digest = hashlib.sha256(f"{SECTIONS_VERSION}:{name}".encode("utf-8"))
+        if name == "policy":
+            digest.update(additional_data.encode("utf-8"))
+        for template in SECTION_INPUTS[name]:
+            path = template.format(user=user)
+            if not os.path.exists(path):
+                return None
+            digest.update(cache.file_hash(path).encode("utf-8"))
+        return digest.hexdigest()
+
+    return {name: fingerprint(name) for name in order}
+
+
+def _optional_sections(user: str) -> List[str]:
+    # optional documents are picked up from what the user uploaded, saved
+    # as <document>.<extension>
+    try:
+        with os.scandir(f"static/docs/{user}") as entries:
+            uploaded = {entry.name.rsplit(".", 1)[0] for entry in entries}
+    except FileNotFoundError:
+        uploaded = set()
+    return [name for name in ["reports", "prescriptions", "claim"] if name in uploaded]
+
+
+def section_order(user: str) -> List[str]:
+    """
+    Return the sections assessed for the user, in the order they are merged.
+    """
+
+    return ["policy", "bills", "discharge"] + _optional_sections(user)
+
+
+def iter_sections(
+    user_obj: PolicyQuestion,
+    user: str,
+    additional_data: str,
+    timeout: int = SECTION_TIMEOUT,
+) -> Iterator[Tuple[str, Optional[Dict], Optional[str]]]:
+    """
+    Run every section of a claim assessment concurrently and yield each one
+    as soon as it finishes.
+
+    Every section only depends on its own document, the bill assessment
+    loads the parsed policy persisted for the user. Sections whose inputs are
+    unchanged since the last assessment are yielded first from the results
+    persisted in docs/<user>/sections.json without calling the LLM. With
+    COMBINED_MODE the policy, bills and discharge sections are asked in a
+    single request when all three have to be computed.
+
+    Parameters
+    ----------
+    user_obj : PolicyQuestion
+        PolicyQuestion object of the user
+    user : str
+        User whose uploaded documents are assessed
+    additional_data : str
+        Details provided by the user in the claim form
+    timeout : int
+        Seconds each section may take
+
+    Yields
+    ------
+    The name of the section, its answers or None if it failed, and the error
+    message or None if it succeeded.
+    """
+
+    sections = {
+        "policy": lambda: user_obj.get_policy_details(
+            f"static/docs/{user}/policy.pdf", additional_data=additional_data
+        ),
+        "bills": lambda: user_obj.get_bill_details(
+            policy_path=f"static/docs/{user}/policy.pdf"
+        ),
+        "discharge": lambda: user_obj.get_discharge_details(
+            path=f"static/docs/{user}/discharge.pdf"
+        ),
+        "reports": lambda: user_obj.get_report_details(
+            path=f"static/docs/{user}/reports.pdf"
+        ),
+        "prescriptions": lambda: user_obj.get_prescription_details(
+            file_name="prescriptions"
+        ),
+        "claim": lambda: user_obj.get_claim_details(file_name="claim"),
+    }
+    order = section_order(user)
+
+    # sections whose inputs did not change since the last assessment are reused
+    fingerprints = section_fingerprints(user, order, additional_data)
+    persisted = _read_sections(user) if SECTION_REUSE else {}
+    todo = []
+    for name in order:
+        entry = persisted.get(name)
+        if entry and fingerprints[name] is not None and entry["inputs"] == fingerprints[name]:
+            metrics.inc("sections_total", section=name, result="reused")
+            print(f"section {name} reused")
+            yield name, entry["result"], None
+        else:
+            todo.append(name)
+    if not todo:
+        return
+
+    executor = ThreadPoolExecutor(max_workers=len(todo))
+    start = time.monotonic()
+    futures = {}
+    if COMBINED_MODE and all(name in todo for name in COMBINED_SECTIONS):
+        # policy, bills and discharge share one request, the whole group is
+        # submitted again section by section if the request is too large
+        future = executor.submit(
+            user_obj.get_combined_details,
+            f"static/docs/{user}/policy.pdf",
+            f"static/docs/{user}/discharge.pdf",
+            additional_data,
+        )
+        futures[future] = "combined"
+        todo = [name for name in todo if name not in COMBINED_SECTIONS]
+    for name in todo:
+        futures[executor.submit(sections[name])] = name
+
+    def finished(name: str, result: Optional[Dict], error: Optional[str]):
+        print(f"section {name} done in {time.monotonic() - start:.1f}s")
+        if error is None and fingerprints[name] is not None:
+            _save_section(user, name, fingerprints[name], result)
+        metrics.inc("sections_total", section=name, result="computed" if error is None else "failed")
+        return name, result, error
+
+    try:
+        while futures:
+            done, _ = wait(
+                futures,
+                timeout=max(0, start + timeout - time.monotonic()),
+                return_when=FIRST_COMPLETED,
+            )
+            if not done:
+                raise TimeoutError()
+            for future in done:
+                name = futures.pop(future)
+                try:
+                    result, error = future.result(), None
+                except Exception as e:
+                    result, error = None, str(e)
+                if name != "combined":
+                    yield finished(name, result, error)
+                elif result is None:
+                    if error is not None:
+                        print(f"combined request failed: {error}")
+                    for section in COMBINED_SECTIONS:
+                        futures[executor.submit(sections[section])] = section
+                else:
+                    for section in COMBINED_SECTIONS:
+                        yield finished(section, result[section], None)
+    except TimeoutError:
+        for name in futures.values():
+            for section in COMBINED_SECTIONS if name == "combined" else [name]:
+                yield section, None, f"timed out after {timeout} seconds"
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def assess_claim(
+    user_obj: PolicyQuestion,
+    user: str,
+    additional_data: str,
+    timeout: int = SECTION_TIMEOUT,
+) -> Tuple[Dict, Dict[str, str]]:
+    """
+    Run every section of a claim assessment concurrently and merge the answers.
+
+    Parameters
+    ----------
+    user_obj : PolicyQuestion
+        PolicyQuestion object of the user
+    user : str
+        User whose uploaded documents are assessed
+    additional_data : str
+        Details provided by the user in the claim form
+    timeout : int
+        Seconds each section may take
+
+    Returns
+    -------
+    The merged answers of every section that succeeded and a mapping of the
+    failed sections to their error message.
+    """
+
+    results = {}
+    errors = {}
+    for name, result, error in iter_sections(user_obj, user, additional_data, timeout):
+        if error is None:
+            results[name] = result
+        else:
+            errors[name] = error
+
+    order = section_order(user)
+    response = {k: v for name in order if name in results for k, v in results[name].items()}
+    return response, errors
@@ -0,0 +1,205 @@
+"""
+Re-assess a directory of archived claims.
+
+Every sub directory of the claims directory is one claim holding the same
+documents a user uploads, policy.pdf, discharge.pdf and bills.pdf and
+optionally reports, prescriptions and claim, plus an optional form.json with
+the claim form fields (start-date, disease, diagnose-date, drink-smoke).
+
+Claims are assessed across a process pool and every finished claim is
+appended to the output as one JSON line. Claims already assessed successfully
+in the output are skipped, so an interrupted run resumes where it stopped.
+
+    python batch.py claims/ --output assessments.jsonl --processes 8 --llm-concurrency 32
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Set
+
+# worker processes and LLM calls in flight across all of them
+BATCH_PROCESSES = int(os.getenv("BATCH_PROCESSES", str(os.cpu_count() or 1)))
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "16"))
+
+REQUIRED_DOCUMENTS = ["policy", "discharge", "bills"]
+OPTIONAL_DOCUMENTS = ["reports", "prescriptions", "claim"]
+
+
+def _init(semaphore):
+    import clients
+
+    clients.set_concurrency_limit(semaphore)
+
+
+def find_claims(claims_dir: str) -> List[str]:
+    """
+    Return the ids of the claims in the directory, the names of its sub directories.
+    """
+
+    return sorted(
+        name
+        for name in os.listdir(claims_dir)
+        if os.path.isdir(os.path.join(claims_dir, name))
+    )
+
+
+def completed_claims(output: str) -> Set[str]:
+    """
+    Return the ids of the claims whose every section was assessed in an
+    earlier run, failed and partial claims are assessed again.
+    """
+
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line of an interrupted run may be cut off
+                continue
+            if record.get("status") == "done":
+                done.add(record["claim_id"])
+    return done
+
+
+def assess(claims_dir: str, claim_id: str) -> Dict:
+    """
+    Assess a single claim, run inside a worker process.
+
+    The documents are copied to where the web app stores uploads of the user
+    batch-<claim_id>, processed like uploads and assessed section by section.
+
+    Parameters
+    ----------
+    claims_dir : str
+        Directory holding the claims
+    claim_id : str
+        Name of the claim directory
+    """
+
+    import jobs
+    from main import PolicyQuestion
+    from assessment import assess_claim, claimant_details
+
+    start = time.perf_counter()
+    source = os.path.join(claims_dir, claim_id)
+    user = f"batch-{claim_id}"
+    try:
+        files = {
+            name.rsplit(".", 1)[0]: name
+            for name in os.listdir(source)
+            if name.rsplit(".", 1)[0] in REQUIRED_DOCUMENTS + OPTIONAL_DOCUMENTS
+        }
+        missing = [name for name in REQUIRED_DOCUMENTS if name not in files]
+        if missing:
+            raise Exception(f"missing documents: {', '.join(missing)}")
+
+        form = {}
+        if os.path.exists(os.path.join(source, "form.json")):
+            with open(os.path.join(source, "form.json"), "r") as f:
+                form = json.load(f)
+        form = {k: v if isinstance(v, list) else [v] for k, v in form.items()}
+
+        shutil.rmtree(f"static/docs/{user}", ignore_errors=True)
+        os.makedirs(f"static/docs/{user}", exist_ok=True)
+        for document, name in files.items():
+            path = f"static/docs/{user}/{document}.{name.rsplit('.', 1)[-1]}"
+            shutil.copyfile(os.path.join(source, name), path)
+            jobs.process_document(user, document, path)
+
+        response, errors = assess_claim(PolicyQuestion(user), user, claimant_details(form))
+        # claims with a failed section are retried by the next run
+        status = "failed" if not response else "partial" if errors else "done"
+    except Exception as e:
+        print(f"claim {claim_id} failed: {e}")
+        response, errors, status = {}, {"claim": str(e)}, "failed"
+    return {
+        "claim_id": claim_id,
+        "status": status,
+        "result": response,
+        "errors": errors,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def run(
+    claims_dir: str,
+    output: str,
+    processes: int = BATCH_PROCESSES,
+    llm_concurrency: int = BATCH_LLM_CONCURRENCY,
+) -> Dict:
+    """
+    Assess every claim of the directory not yet in the output.
+
+    Parameters
+    ----------
+    claims_dir : str
+        Directory holding one sub directory per claim
+    output : str
+        JSON lines file the results are appended to
+    processes : int
+        Number of worker processes
+    llm_concurrency : int
+        LLM calls in flight across all worker processes
+
+    Returns
+    -------
+    The number of claims assessed, failed and skipped, and the throughput in
+    claims per hour.
+    """
+
+    claims = find_claims(claims_dir)
+    done = completed_claims(output)
+    todo = [claim_id for claim_id in claims if claim_id not in done]
+    print(f"{len(claims)} claims, {len(done)} already assessed, {len(todo)} to go")
+
+    stats = {"assessed": 0, "failed": 0, "skipped": len(claims) - len(todo)}
+    start = time.perf_counter()
+    semaphore = multiprocessing.Semaphore(llm_concurrency)
+    with ProcessPoolExecutor(
+        max_workers=processes, initializer=_init, initargs=(semaphore,)
+    ) as executor, open(output, "a") as f:
+        futures = {executor.submit(assess, claims_dir, claim_id): claim_id for claim_id in todo}
+        for future in as_completed(futures):
+            try:
+                record = future.result()
+            except Exception as e:
+                # the worker process died
+                record = {"claim_id": futures[future], "status": "failed", "result": {}, "errors": {"claim": str(e)}}
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            stats["assessed" if record["status"] == "done" else "failed"] += 1
+
+            finished = stats["assessed"] + stats["failed"]
+            hours = (time.perf_counter() - start) / 3600
+            print(f"{finished}/{len(todo)} claims, {finished / hours:.0f} claims/hour")
+
+    hours = (time.perf_counter() - start) / 3600
+    finished = stats["assessed"] + stats["failed"]
+    stats["claims_per_hour"] = round(finished / hours, 1) if finished else 0.0
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("claims_dir", help="directory with one sub directory per claim")
+    parser.add_argument("--output", default="assessments.jsonl", help="JSON lines file the results are appended to")
+    parser.add_argument("--processes", type=int, default=BATCH_PROCESSES)
+    parser.add_argument("--llm-concurrency", type=int, default=BATCH_LLM_CONCURRENCY, help="LLM calls in flight across all processes")
+    args = parser.parse_args(argv)
+
+    stats = run(args.claims_dir, args.output, args.processes, args.llm_concurrency)
+    print(json.dumps(stats))
+    return 0 if stats["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+Measure gunicorn cold start and worker memory with and without preloading.
+
+Starts gunicorn with the fake LLM app once with GUNICORN_PRELOAD=0 (every
+worker imports the app and loads the parsing stack on its first request) and
+once with GUNICORN_PRELOAD=1 (imported and warmed up in the master before
+forking) and reports:
+
+- boot_seconds: until the first request is answered
+- first_request_seconds: the first /policy-coverage request, which partitions a new policy
+- warm_request_seconds: the same request for another policy afterwards
+- rss_mb / pss_mb: resident and proportional set size per worker, PSS counts
+  pages shared copy-on-write with the master only partially
+
+    python -m bench.coldstart --workers 4
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.serving import _post, _wait, serve  # noqa: E402
+
+
+def _memory(pid: int) -> dict:
+    # Rss and Pss of the process in kB
+    memory = {}
+    with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("Rss", "Pss"):
+                memory[key] = int(value.split()[0])
+    return memory
+
+
+def _children(pid: int) -> list:
+    with open(f"/proc/{pid}/task/{pid}/children", "r") as f:
+        return [int(child) for child in f.read().split()]
+
+
+def run(preload: bool, workers: int, port: int, policies: list) -> dict:
+    workspace = tempfile.mkdtemp(prefix="bench-coldstart-")
+    shutil.copytree(os.path.join(ROOT, "templates"), os.path.join(workspace, "templates"))
+    shutil.copytree(os.path.join(ROOT, "static"), os.path.join(workspace, "static"))
+    flag = "1" if preload else "0"
+    start = time.perf_counter()
+    process = serve("gthread", workers, port, 0, workspace, GUNICORN_PRELOAD=flag, WARMUP=flag)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        _wait(url, process, timeout=600)
+        boot = time.perf_counter() - start
+        first = _post(url, policies[0], "bench-coldstart-0")
+        warm = _post(url, policies[1], "bench-coldstart-1")
+        memory = [_memory(pid) for pid in _children(process.pid)]
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    return {
+        "preload": preload,
+        "workers": workers,
+        "boot_seconds": round(boot, 3),
+        "first_request_seconds": round(first, 3),
+        "warm_request_seconds": round(warm, 3),
+        "rss_mb": [round(m["Rss"] / 1024, 1) for m in memory],
+        "pss_mb": [round(m["Pss"] / 1024, 1) for m in memory],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=5056)
+    parser.add_argument("--output", help="write the results as JSON lines to this file")
+    args = parser.parse_args(argv)
+
+    from bench.documents import make_pdf
+
+    policies = []
+    for pages in [1, 2]:
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as f:
+            make_pdf(f.name, "policy", pages)
+            policies.append(f.read())
+
+    results = []
+    for preload in [False, True]:
+        result = run(preload, args.workers, args.port, policies)
+        results.append(result)
+        print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+from PIL import Image, ImageDraw
+
+PAGE_SIZE = (1240, 1754)  # A4 at 150 dpi
+
+TEXT = {
+    "policy": [
+        "HEALTH INSURANCE POLICY WORDING",
+        "Policy holder: John Doe",
+        "Sum insured: Rs 5,00,000 including cumulative bonus",
+        "Room rent limit: 1% of sum insured per day",
+        "Pre hospitalization expenses covered up to 30 days",
+        "Post hospitalization expenses covered up to 60 days",
+        "Waiting period for pre existing diseases: 48 months",
+        "Co-payment: 10% on all claims",
+        "Non medical expenses and consumables are excluded",
+    ],
+    "discharge": [
+        "DISCHARGE SUMMARY",
+        "Hospital: City General Hospital",
+        "Consultant: Dr. A. Sharma",
+        "Diagnosis: Acute appendicitis",
+        "Procedure: Laparoscopic appendectomy",
+        "Condition at discharge: Stable",
+    ],
+    "bills": [
+        "PHARMACY BILL",
+        "City Pharmacy, Invoice 1234, Date 01/01/2024",
+        "Paracetamol 500mg   10 x 5.00   50.00",
+        "Ceftriaxone 1g       4 x 80.00  320.00",
+        "Bandage              2 x 60.00  120.00",
+        "Diapers              1 x 250.00 250.00",
+        "Total                           740.00",
+    ],
+}
+
+
+def make_pdf(path: str, kind: str, pages: int):
+    """
+    Write a scanned-looking PDF with the given number of pages.
+
+    Parameters
+    ----------
+    path : str
+        Path of the PDF to write
+    kind : str
+        Document type, one of policy, discharge or bills
+    pages : int
+        Number of pages
+    """
+
+    images = []
+    for page in range(pages):
+        image = Image.new("L", PAGE_SIZE, 255)
+        draw = ImageDraw.Draw(image)
+        y = 80
+        lines = TEXT[kind] + [f"Page {page + 1} of {pages}"]
+        # fill the page so every page carries a realistic amount of text
+        while y < PAGE_SIZE[1] - 120:
+            for line in lines:
+                draw.text((80, y), line, fill=0)
+                y += 28
+        images.append(image)
+    images[0].save(path, "PDF", resolution=150, save_all=True, append_images=images[1:])
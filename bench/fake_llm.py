@@ -0,0 +1,117 @@
+import re
+import time
+import json
+import asyncio
+import threading
+
+from langchain_core.messages import AIMessage
+
+import clients
+
+
+class FakeChatModel:
+    def __init__(self, latency: float = 0.5, page_latency: float = None):
+        """
+        Deterministic stand-in for AzureChatOpenAI.
+
+        Text prompts are answered with a JSON object holding every key of the
+        response format requested in the prompt, page images with a canned
+        bill description.
+
+        Parameters
+        ----------
+        latency : float
+            Seconds every text call takes
+        page_latency : float
+            Seconds every image call takes, defaults to latency
+        """
+
+        self.latency = latency
+        self.page_latency = latency if page_latency is None else page_latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _respond(self, messages):
+        with self._lock:
+            self.calls += 1
+        if isinstance(messages, str):
+            keys = dict.fromkeys(re.findall(r'"([a-z0-9-]+)"\s*:', messages))
+            answer = {k: f"synthetic {k}" for k in keys}
+            if "items" in answer:
+                # the bill assessment asks for line items and reconciles them locally
+                bill = {
+                    "pharmacy-name": "synthetic pharmacy-name",
+                    "items": [
+                        {"description": "Paracetamol 500mg", "qty": 10, "unit-price": 5, "amount": 50, "category": "medicine"},
+                        {"description": "Bandage", "qty": 2, "unit-price": 60, "amount": 120, "category": "consumable"},
+                        {"description": "Attendant food", "qty": 1, "unit-price": 200, "amount": 200, "category": "non-medical"},
+                    ],
+                    "printed-total": 370,
+                    "max-reimbursement": 500000,
+                    "co-payment": 10,
+                }
+                keys = list(keys)
+                if "policy" in keys and "discharge" in keys:
+                    # combined request, the keys of every part follow its name
+                    answer = {
+                        "policy": {k: f"synthetic {k}" for k in keys[keys.index("policy") + 1:keys.index("bills")]},
+                        "bills": bill,
+                        "discharge": {k: f"synthetic {k}" for k in keys[keys.index("discharge") + 1:]},
+                    }
+                else:
+                    answer = bill
+            content = "```json\n" + json.dumps(answer) + "\n```"
+            return self.latency, AIMessage(
+                content=content,
+                usage_metadata={
+                    "input_tokens": len(messages) // 4,
+                    "output_tokens": len(content) // 4,
+                    "total_tokens": (len(messages) + len(content)) // 4,
+                },
+            )
+        page = (
+            "Date: 01/01/2024\n"
+            "Paracetamol 500mg x 10 = 50.00\n"
+            "Bandage x 2 = 120.00\n"
+            "Total: 170.00"
+        )
+        images = sum(
+            1
+            for message in messages
+            if isinstance(message["content"], list)
+            for part in message["content"]
+            if part["type"] == "image_url"
+        )
+        if images > 1:
+            # batched pages are answered with one section per page
+            content = "\n".join(f"=== Page {k} ===\n{page}" for k in range(1, images + 1))
+        else:
+            content = page
+        return self.page_latency, AIMessage(
+            content=content,
+            usage_metadata={
+                "input_tokens": 1000 * images,
+                "output_tokens": 40 * images,
+                "total_tokens": 1040 * images,
+            },
+        )
+
+    def invoke(self, messages, *args, **kwargs):
+        latency, response = self._respond(messages)
+        time.sleep(latency)
+        return response
+
+    async def ainvoke(self, messages, *args, **kwargs):
+        latency, response = self._respond(messages)
+        await asyncio.sleep(latency)
+        return response
+
+
+def install(latency: float = 0.5, page_latency: float = None) -> FakeChatModel:
+    """
+    Make every PolicyQuestion and pdf2text call use a fake model.
+    """
+
+    fake = FakeChatModel(latency, page_latency)
+    clients.set_llm(fake)
+    return fake
@@ -0,0 +1,241 @@
+"""
+Offline benchmark of the claim pipeline.
+
+Runs pdf2text, the PolicyQuestion sections and the /policy-coverage,
+/claim-assessment and /claim-assessment/stream routes against a local fake LLM and synthetic PDFs and
+reports wall time, per-stage time and peak memory.
+
+    python -m bench.run --pages 1 5 20 --max-in-flight 1 4 8 --latency 0.5
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import tracemalloc
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _stage_totals(metrics) -> dict:
+    totals = defaultdict(float)
+    for key, hist in metrics._histograms.items():
+        name, labels = json.loads(key)
+        labels = dict(labels)
+        if name == "stage_duration_seconds":
+            totals[labels["stage"]] += hist["sum"]
+        elif name == "llm_duration_seconds":
+            totals[f"llm:{labels['stage']}"] += hist["sum"]
+    return totals
+
+
+class Bench:
+    def __init__(self):
+        import metrics
+
+        self.metrics = metrics
+        self.results = []
+
+    def measure(self, name: str, fn, **params):
+        """
+        Run fn once and record its wall time, per-stage time and peak memory.
+        """
+
+        before = _stage_totals(self.metrics)
+        tracemalloc.start()
+        start = time.perf_counter()
+        error = None
+        try:
+            fn()
+        except Exception as e:
+            error = str(e)
+        wall = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        after = _stage_totals(self.metrics)
+        stages = {k: round(after[k] - before.get(k, 0), 3) for k in after if after[k] != before.get(k, 0)}
+        result = {
+            "name": name,
+            **params,
+            "wall_seconds": round(wall, 3),
+            "peak_python_mb": round(peak / 1024 / 1024, 1),
+            "stages": stages,
+            "error": error,
+        }
+        self.results.append(result)
+        print(json.dumps(result))
+        return result
+
+
+def clear_cache():
+    import cache
+    import pagehash
+
+    shutil.rmtree(cache.CACHE_DIR, ignore_errors=True)
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(pagehash.PAGE_INDEX_DB + suffix):
+            os.remove(pagehash.PAGE_INDEX_DB + suffix)
+    pagehash._local.conn = None
+
+
+def bench_pdf2text(bench: Bench, docs: dict, pages: list, max_in_flight: list):
+    from extract import pdf2text
+
+    for n in pages:
+        for limit in max_in_flight:
+            clear_cache()
+            bench.measure(
+                "pdf2text",
+                lambda: pdf2text(docs[("bills", n)], "bench", max_in_flight=limit),
+                pages=n,
+                max_in_flight=limit,
+            )
+
+
+def bench_sections(bench: Bench, docs: dict, pages: list):
+    from main import PolicyQuestion
+
+    for n in pages:
+        clear_cache()
+        user = f"bench-sections-{n}"
+        user_obj = PolicyQuestion(user)
+        user_obj.load_doc(docs[("bills", n)], file_name="bills")
+        bench.measure(
+            "get_policy_details",
+            lambda: user_obj.get_policy_details(docs[("policy", n)], additional_data="none"),
+            pages=n,
+        )
+        bench.measure("get_bill_details", lambda: user_obj.get_bill_details(), pages=n)
+        bench.measure(
+            "get_discharge_details",
+            lambda: user_obj.get_discharge_details(path=docs[("discharge", n)]),
+            pages=n,
+        )
+
+
+def _form(user: str) -> dict:
+    return {
+        "user": user,
+        "start-date": "2020-01-01",
+        "disease": "none",
+        "diagnose-date": "",
+        "drink-smoke": "none",
+    }
+
+
+def bench_routes(bench: Bench, docs: dict, pages: list):
+    import jobs
+    from app import app
+
+    client = app.test_client()
+    for n in pages:
+        clear_cache()
+        user = f"bench-routes-{n}"
+
+        def policy_coverage():
+            with open(docs[("policy", n)], "rb") as f:
+                data = {**_form(user), "file": (io.BytesIO(f.read()), "policy.pdf")}
+            res = client.post("/policy-coverage", data=data, content_type="multipart/form-data")
+            assert res.status_code == 200, res.status_code
+
+        bench.measure("route:/policy-coverage", policy_coverage, pages=n)
+
+        def upload():
+            for kind in ["policy", "discharge", "bills"]:
+                with open(docs[(kind, n)], "rb") as f:
+                    data = {"user": user, kind: (io.BytesIO(f.read()), f"{kind}.pdf")}
+                client.post(
+                    f"/doc/{kind}",
+                    data=data,
+                    content_type="multipart/form-data",
+                    headers={"Accept": "application/json"},
+                )
+            while jobs.pending(user):
+                time.sleep(0.05)
+            return {**_form(user), "docs": json.dumps(["policy", "discharge", "bills"])}
+
+        def claim_assessment():
+            res = client.post("/claim-assessment", data=upload())
+            assert res.status_code == 200, res.status_code
+
+        bench.measure("route:/claim-assessment", claim_assessment, pages=n)
+
+        clear_cache()
+        user = f"bench-routes-stream-{n}"
+        first = {}
+
+        def claim_assessment_stream():
+            data = upload()
+            start = time.perf_counter()
+            res = client.post("/claim-assessment/stream", data=data, buffered=False)
+            assert res.status_code == 200, res.status_code
+            for chunk in res.response:
+                # time until the first section reached the client
+                if b'"section": "form"' not in chunk and "seconds" not in first:
+                    first["seconds"] = round(time.perf_counter() - start, 3)
+            res.close()
+
+        result = bench.measure("route:/claim-assessment/stream", claim_assessment_stream, pages=n)
+        result["first_section_seconds"] = first.get("seconds")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--max-in-flight", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per fake text LLM call")
+    parser.add_argument("--page-latency", type=float, default=None, help="seconds per fake page image call")
+    parser.add_argument("--only", choices=["pdf2text", "sections", "routes"], nargs="+", default=["pdf2text", "sections", "routes"])
+    parser.add_argument("--output", help="write the results as JSON lines to this file")
+    args = parser.parse_args(argv)
+    output = os.path.abspath(args.output) if args.output else None
+
+    # the synthetic pages differ only in their text, measure every page
+    # through the vision model rather than reusing earlier pages or local OCR
+    os.environ.setdefault("PAGE_DEDUP", "0")
+    os.environ.setdefault("OCR_FAST_PATH", "0")
+
+    # everything the pipeline writes goes to a scratch workspace
+    workspace = tempfile.mkdtemp(prefix="bench-")
+    os.chdir(workspace)
+    sys.path.insert(0, ROOT)
+    shutil.copytree(os.path.join(ROOT, "templates"), "templates")
+    shutil.copytree(os.path.join(ROOT, "static"), "static")
+
+    from bench import fake_llm
+    from bench.documents import make_pdf
+
+    fake = fake_llm.install(args.latency, args.page_latency)
+
+    docs = {}
+    os.makedirs("synthetic", exist_ok=True)
+    for n in args.pages:
+        for kind in ["policy", "discharge", "bills"]:
+            docs[(kind, n)] = os.path.abspath(f"synthetic/{kind}-{n}.pdf")
+            make_pdf(docs[(kind, n)], kind, n)
+
+    bench = Bench()
+    if "pdf2text" in args.only:
+        bench_pdf2text(bench, docs, args.pages, args.max_in_flight)
+    if "sections" in args.only:
+        bench_sections(bench, docs, args.pages)
+    if "routes" in args.only:
+        bench_routes(bench, docs, args.pages)
+
+    print(f"fake LLM calls: {fake.calls}")
+    print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    if output:
+        with open(output, "w") as f:
+            for result in bench.results:
+                f.write(json.dumps(result) + "\n")
+    shutil.rmtree(workspace, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Compare gunicorn worker classes serving /policy-coverage against the fake LLM.
+
+Starts gunicorn once per worker class, fires concurrent requests at it and
+reports throughput and latency. Every request comes from a different user, so
+each one makes an LLM call while the parsed policy is served from the cache.
+
+    python -m bench.serving --worker-class sync gthread gevent --concurrency 4 16 64 --requests 128
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _form(user: str) -> dict:
+    return {
+        "user": user,
+        "start-date": "2020-01-01",
+        "disease": "none",
+        "diagnose-date": "",
+        "drink-smoke": "none",
+    }
+
+
+def _post(url: str, policy: bytes, user: str) -> float:
+    start = time.perf_counter()
+    res = requests.post(
+        f"{url}/policy-coverage",
+        data=_form(user),
+        files={"file": ("policy.pdf", policy, "application/pdf")},
+        timeout=600,
+    )
+    res.raise_for_status()
+    return time.perf_counter() - start
+
+
+def _wait(url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with {process.returncode}")
+        try:
+            requests.get(f"{url}/home", timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError("gunicorn did not start")
+
+
+def serve(worker_class: str, workers: int, port: int, latency: float, workspace: str, **settings) -> subprocess.Popen:
+    """
+    Start gunicorn with the fake LLM app in the workspace.
+
+    Extra keyword arguments are passed to gunicorn.conf.py as environment
+    variables, e.g. GUNICORN_PRELOAD="0".
+    """
+
+    env = {
+        **os.environ,
+        "GUNICORN_BIND": f"127.0.0.1:{port}",
+        "GUNICORN_WORKERS": str(workers),
+        "GUNICORN_WORKER_CLASS": worker_class,
+        "BENCH_LLM_LATENCY": str(latency),
+        **settings,
+    }
+    return subprocess.Popen(
+        [
+            sys.executable, "-m", "gunicorn",
+            "-c", os.path.join(ROOT, "gunicorn.conf.py"),
+            "--chdir", workspace,
+            "--pythonpath", ROOT,
+            "bench.serving_app:app",
+        ],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def run(worker_class: str, workers: int, concurrency: int, requests_count: int, latency: float, policy: bytes, port: int) -> dict:
+    workspace = tempfile.mkdtemp(prefix="bench-serving-")
+    shutil.copytree(os.path.join(ROOT, "templates"), os.path.join(workspace, "templates"))
+    shutil.copytree(os.path.join(ROOT, "static"), os.path.join(workspace, "static"))
+    process = serve(worker_class, workers, port, latency, workspace)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        _wait(url, process)
+        # parse the policy once so the measured requests only wait on the LLM
+        _post(url, policy, "bench-serving-warmup")
+
+        errors = 0
+        durations = []
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [
+                executor.submit(_post, url, policy, f"bench-serving-{i}")
+                for i in range(requests_count)
+            ]
+            for future in futures:
+                try:
+                    durations.append(future.result())
+                except Exception:
+                    errors += 1
+        wall = time.perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    durations.sort()
+    return {
+        "worker_class": worker_class,
+        "workers": workers,
+        "concurrency": concurrency,
+        "requests": requests_count,
+        "errors": errors,
+        "wall_seconds": round(wall, 3),
+        "requests_per_second": round(len(durations) / wall, 2),
+        "p50_seconds": round(statistics.median(durations), 3) if durations else None,
+        "p95_seconds": round(durations[int(len(durations) * 0.95) - 1], 3) if durations else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--worker-class", nargs="+", default=["sync", "gthread", "gevent"])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--requests", type=int, default=128)
+    parser.add_argument("--latency", type=float, default=2, help="seconds per fake LLM call")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--output", help="write the results as JSON lines to this file")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, ROOT)
+    from bench.documents import make_pdf
+
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as f:
+        make_pdf(f.name, "policy", 1)
+        policy = f.read()
+
+    results = []
+    for worker_class in args.worker_class:
+        for concurrency in args.concurrency:
+            result = run(worker_class, args.workers, concurrency, args.requests, args.latency, policy, args.port)
+            results.append(result)
+            print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+"""
+The Flask app wired to the fake LLM, served by bench.serving.
+
+    gunicorn -c gunicorn.conf.py bench.serving_app:app
+"""
+
+import os
+
+from bench import fake_llm
+
+fake_llm.install(float(os.getenv("BENCH_LLM_LATENCY", "2")))
+
+from app import app  # noqa: E402
@@ -0,0 +1,251 @@
+"""
+Exercise the shared LLM rate limiter against a local stub of Azure OpenAI.
+
+The stub serves chat completions with a fixed latency and answers 429 with a
+Retry-After header once its requests or tokens per minute or its concurrent
+requests are exceeded. Several processes with several threads each call it
+through clients.invoke, like gunicorn workers, once without and once with the
+rate limiter, and the 429s, throughput and latency are reported.
+
+    python -m bench.throttling --processes 4 --threads 8 --calls 200 --rpm 600 --max-concurrent 8
+
+The stub can also be run on its own to point the app at it:
+
+    python -m bench.throttling --serve --port 5060
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import statistics
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StubOpenAI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, rpm: float, tpm: float, max_concurrent: int, latency: float):
+        """
+        Chat completions endpoint with Azure OpenAI style throttling.
+
+        Parameters
+        ----------
+        port : int
+            Port to listen on
+        rpm : float
+            Requests accepted per minute, 0 for no limit
+        tpm : float
+            Prompt tokens accepted per minute, 0 for no limit
+        max_concurrent : int
+            Requests served at the same time, 0 for no limit
+        latency : float
+            Seconds every completion takes
+        """
+
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrent = max_concurrent
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.window = deque()
+            self.in_flight = 0
+            self.stats = {"requests": 0, "throttled": 0, "completed": 0}
+
+    def admit(self, tokens: int) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            self.stats["requests"] += 1
+            while self.window and self.window[0][0] < now - 60:
+                self.window.popleft()
+            over = (
+                (self.rpm and len(self.window) + 1 > self.rpm)
+                or (self.tpm and sum(t for _, t in self.window) + tokens > self.tpm)
+                or (self.max_concurrent and self.in_flight >= self.max_concurrent)
+            )
+            if over:
+                self.stats["throttled"] += 1
+                return False
+            self.window.append((now, tokens))
+            self.in_flight += 1
+            return True
+
+    def done(self):
+        with self.lock:
+            self.in_flight -= 1
+            self.stats["completed"] += 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send(200, self.server.stats)
+        else:
+            self._send(404, {})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/reset":
+            self.server.reset()
+            self._send(200, {})
+            return
+        prompt_tokens = len(body) // 4
+        if not self.server.admit(prompt_tokens):
+            self._send(
+                429,
+                {"error": {"code": "429", "message": "Requests to the deployment have exceeded the rate limit. Please retry after 1 second."}},
+                {"Retry-After": "1"},
+            )
+            return
+        try:
+            time.sleep(self.server.latency)
+            content = '{"answer": "stub"}'
+            self._send(
+                200,
+                {
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": "gpt-4o",
+                    "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": len(content) // 4,
+                        "total_tokens": prompt_tokens + len(content) // 4,
+                    },
+                },
+            )
+        finally:
+            self.server.done()
+
+
+def _worker(port: int, threads: int, calls: int, rate_limit: bool, db: str, results):
+    # one process standing in for a gunicorn worker
+    os.environ.update(
+        {
+            "AZURE_OPENAI_ENDPOINT": f"http://127.0.0.1:{port}",
+            "AZURE_OPENAI_API_KEY": "bench",
+            "AZURE_OPENAI_API_VERSION": "2024-06-01",
+            "AZURE_OPENAI_CHAT_DEPLOYMENT_NAME": "bench",
+            "RATE_LIMIT": "1" if rate_limit else "0",
+            "RATE_LIMIT_DB": db,
+            "LLM_MAX_RETRIES": "10",
+        }
+    )
+    sys.path.insert(0, ROOT)
+    import clients
+
+    def call(i):
+        start = time.perf_counter()
+        try:
+            clients.invoke(clients.get_llm(), f"Answer in json. Question {i}: " + "policy text " * 200, stage="bench")
+        except Exception as e:
+            return None, str(e)
+        return time.perf_counter() - start, None
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results.put(list(executor.map(call, range(calls))))
+
+
+def run(port: int, processes: int, threads: int, calls: int, rate_limit: bool) -> dict:
+    import requests
+
+    requests.post(f"http://127.0.0.1:{port}/reset")
+    results = multiprocessing.Queue()
+    db = os.path.join(tempfile.mkdtemp(prefix="bench-ratelimit-"), "ratelimit.db")
+    start = time.perf_counter()
+    workers = [
+        multiprocessing.Process(
+            target=_worker,
+            args=(port, threads, calls // processes, rate_limit, db, results),
+        )
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    outcomes = [outcome for _ in workers for outcome in results.get()]
+    for worker in workers:
+        worker.join()
+    wall = time.perf_counter() - start
+
+    durations = sorted(duration for duration, error in outcomes if error is None)
+    stats = requests.get(f"http://127.0.0.1:{port}/stats").json()
+    return {
+        "rate_limit": rate_limit,
+        "processes": processes,
+        "threads": threads,
+        "calls": len(outcomes),
+        "failed": sum(1 for _, error in outcomes if error is not None),
+        "http_requests": stats["requests"],
+        "throttled_429": stats["throttled"],
+        "wall_seconds": round(wall, 3),
+        "calls_per_second": round(len(durations) / wall, 2),
+        "p50_seconds": round(statistics.median(durations), 3) if durations else None,
+        "p95_seconds": round(durations[int(len(durations) * 0.95) - 1], 3) if durations else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=5060)
+    parser.add_argument("--rpm", type=float, default=600, help="requests per minute the stub accepts")
+    parser.add_argument("--tpm", type=float, default=0, help="prompt tokens per minute the stub accepts")
+    parser.add_argument("--max-concurrent", type=int, default=8, help="requests the stub serves at once")
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per completion")
+    parser.add_argument("--serve", action="store_true", help="only run the stub until interrupted")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--output", help="write the results as JSON lines to this file")
+    args = parser.parse_args(argv)
+
+    server = StubOpenAI(args.port, args.rpm, args.tpm, args.max_concurrent, args.latency)
+    if args.serve:
+        print(f"stub Azure OpenAI listening on http://127.0.0.1:{args.port}")
+        server.serve_forever()
+        return
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = []
+    for rate_limit in [False, True]:
+        result = run(args.port, args.processes, args.threads, args.calls, rate_limit)
+        results.append(result)
+        print(json.dumps(result))
+    server.shutdown()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import os
+import json
+import hashlib
+import threading
+
+# directory holding the cached parse results and its maximum size on disk
+CACHE_DIR = os.getenv("DOC_CACHE_DIR", "cache")
+CACHE_MAX_BYTES = int(os.getenv("DOC_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+_lock = threading.Lock()
+_key_locks = {}
+
+
+def file_hash(path: str) -> str:
+    """
+    SHA-256 of the file contents.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file
+    """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(path: str, **params) -> str:
+    """
+    Cache key for a document parsed with the given parameters.
+
+    Parameters
+    ----------
+    path : str
+        Path to the document
+    params :
+        Parser parameters which change the result, e.g. chunking_strategy
+    """
+
+    payload = json.dumps(params, sort_keys=True)
+    return hashlib.sha256((file_hash(path) + payload).encode("utf-8")).hexdigest()
+
+
+def _entry_path(key: str) -> str:
+    return os.path.join(CACHE_DIR, key[:2], key + ".json")
+
+
+def get(key: str):
+    """
+    Return the cached value for ``key`` or None when it is not cached.
+    """
+
+    path = _entry_path(key)
+    try:
+        with open(path, "r") as f:
+            value = json.load(f)
+        # mark the entry as recently used for the LRU eviction
+        os.utime(path)
+    except (FileNotFoundError, ValueError):
+        return None
+    return value
+
+
+def put(key: str, value):
+    """
+    Store a JSON serializable value for ``key`` and evict old entries.
+    """
+
+    path = _entry_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+    _evict()
+
+
+def _evict():
+    # drop the least recently used entries until the cache fits its budget
+    with _lock:
+        entries = []
+        total = 0
+        for root, _, files in os.walk(CACHE_DIR):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def cached(path: str, compute, **params):
+    """
+    Return the parse result of a document, computing and caching it on a miss.
+
+    Parameters
+    ----------
+    path : str
+        Path to the document
+    compute : callable
+        Called without arguments to parse the document on a cache miss
+    params :
+        Parser parameters which are part of the cache key
+    """
+
+    key = cache_key(path, **params)
+    with _lock:
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+    # concurrent callers for the same document wait for a single parse
+    with key_lock:
+        value = get(key)
+        if value is not None:
+            print(f"cache hit for {path}")
+            return value
+        value = compute()
+        put(key, value)
+    with _lock:
+        _key_locks.pop(key, None)
+    return value
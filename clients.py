@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+import httpx
+from dotenv.main import load_dotenv
+from langchain_openai import AzureChatOpenAI
+
+import metrics
+import ratelimit
+
+load_dotenv()
+os.environ["OPENAI_API_TYPE"] = "azure"
+
+# connection pool and timeouts of the HTTP clients shared by all LLM calls
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "300"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+
+_clients = {}
+_lock = threading.Lock()
+# optional semaphore bounding the LLM calls in flight, see set_concurrency_limit
+_limit = None
+
+
+def _http_timeout() -> httpx.Timeout:
+    return httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=LLM_POOL_SIZE,
+        max_keepalive_connections=LLM_POOL_SIZE,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    )
+
+
+def _on_response(response: httpx.Response):
+    # every 429 is reported, including those retried inside the OpenAI client
+    if response.status_code == 429 and ratelimit.RATE_LIMIT:
+        retry_after = response.headers.get("retry-after")
+        try:
+            retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            retry_after = None
+        ratelimit.throttled(retry_after)
+
+
+async def _on_async_response(response: httpx.Response):
+    _on_response(response)
+
+
+def get_llm(temperature: float = 0.8) -> AzureChatOpenAI:
+    """
+    Return the chat client of this process for the given settings.
+
+    Clients are created once per worker and reuse a keep-alive connection
+    pool, so callers can ask for one on every request.
+
+    Parameters
+    ----------
+    temperature : float
+        Sampling temperature of the model
+    """
+
+    key = temperature
+    with _lock:
+        if key not in _clients:
+            _clients[key] = AzureChatOpenAI(
+                openai_api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+                azure_deployment=os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME"),
+                azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+                temperature=temperature,
+                timeout=_http_timeout(),
+                max_retries=LLM_MAX_RETRIES,
+                http_client=httpx.Client(
+                    limits=_http_limits(),
+                    timeout=_http_timeout(),
+                    event_hooks={"response": [_on_response]},
+                ),
+                http_async_client=httpx.AsyncClient(
+                    limits=_http_limits(),
+                    timeout=_http_timeout(),
+                    event_hooks={"response": [_on_async_response]},
+                ),
+            )
+        return _clients[key]
+
+
+def invoke(llm: AzureChatOpenAI, messages, stage: str):
+    """
+    Call the model and record the call duration, sizes and token usage.
+
+    Parameters
+    ----------
+    llm : AzureChatOpenAI
+        Client to call
+    messages : str | list
+        Prompt or chat messages sent to the model
+    stage : str
+        Pipeline stage making the call, used as the metrics label
+    """
+
+    with _limit or nullcontext():
+        if ratelimit.RATE_LIMIT:
+            # wait for the request and token budget shared by all workers
+            tokens = ratelimit.estimate_tokens(messages)
+            lease = ratelimit.acquire(tokens)
+        start = time.perf_counter()
+        response = None
+        try:
+            response = llm.invoke(messages)
+        finally:
+            if ratelimit.RATE_LIMIT:
+                usage = getattr(response, "usage_metadata", None) or {}
+                ratelimit.release(
+                    lease, time.perf_counter() - start, tokens, usage.get("total_tokens")
+                )
+    metrics.record_llm(stage, time.perf_counter() - start, len(str(messages)), response)
+    return response
+
+
+def set_concurrency_limit(semaphore):
+    """
+    Bound the LLM calls in flight, e.g. with a multiprocessing semaphore
+    shared by every process of a batch run.
+    """
+
+    global _limit
+    _limit = semaphore
+
+
+def set_llm(llm, temperature: float = 0.8):
+    """
+    Replace the client of this process, used to run the pipeline against a
+    local fake model in the benchmarks.
+    """
+
+    with _lock:
+        _clients[temperature] = llm
@@ -1,74 +1,370 @@
 import os
+import re
 from dotenv.main import load_dotenv
-from langchain_openai import AzureChatOpenAI
-from unstructured.partition.auto import partition
-import shutil
-from pdf2image import convert_from_path
+import io
+from pdf2image import convert_from_path, pdfinfo_from_path
 import base64
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, List, Optional, Tuple
+import cache
+import clients
+import metrics
+import ocr
+import imaging
+import pagehash
+import textlayer
+from clients import get_llm
 
 load_dotenv()
 os.environ["OPENAI_API_TYPE"] = "azure"
 
+# maximum number of page requests sent to the vision model at the same time
+PAGE_MAX_IN_FLIGHT = int(os.getenv("PAGE_MAX_IN_FLIGHT", "4"))
 
-llm = AzureChatOpenAI(
-    openai_api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-    azure_deployment=os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME"),
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    temperature=0.8,  # print(llm.invoke("hello"))
-)
+# rasterization settings for pages sent to the vision model
+PDF_DPI = int(os.getenv("PDF_DPI", "200"))
+PDF_IMAGE_FORMAT = os.getenv("PDF_IMAGE_FORMAT", "jpeg").lower().replace("jpg", "jpeg")
+PDF_IMAGE_QUALITY = int(os.getenv("PDF_IMAGE_QUALITY", "75"))
 
+# vision pages are packed into one request up to this many images or base64 bytes,
+# 1 sends every page on its own
+VISION_BATCH_IMAGES = int(os.getenv("VISION_BATCH_IMAGES", "1"))
+VISION_BATCH_BYTES = int(os.getenv("VISION_BATCH_BYTES", str(8 * 1024 * 1024)))
 
-def _pdf2image(path: str, user: str):
+# bump whenever the extraction prompt changes so cached results are not reused
+PROMPT_VERSION = "1"
 
-    images = convert_from_path(path)
-    shutil.rmtree(f"images/{user}", ignore_errors=True)
-    os.makedirs(f"images/{user}", exist_ok=True)
-    for i in range(len(images)):
+_PIL_FORMATS = {"jpeg": "JPEG", "png": "PNG", "webp": "WEBP"}
 
-        images[i].save(f"images/{user}/page" + str(i) + ".png", "PNG")
 
+def _pdf2image(path: str, pages: List[int] = None, dpi: int = PDF_DPI):
+    """
+    Rasterize a PDF one page at a time.
 
-# Open the image file and encode it as a base64 string
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+    Only a single page is rasterized at once, pages are yielded as PIL images.
 
+    Parameters
+    ----------
+    path : str
+        Path to the PDF
+    pages : List[int]
+        Zero based indexes of the pages to rasterize, all pages if not given
+    dpi : int
+        Resolution used for rasterization
+    """
 
-def pdf2text(path: str, user: str):
+    if pages is None:
+        pages = range(pdfinfo_from_path(path)["Pages"])
+    for i in pages:
+        with metrics.span("rasterize"):
+            image = convert_from_path(path, dpi=dpi, first_page=i + 1, last_page=i + 1)[0]
+        yield i, image
 
-    _pdf2image(path, user)
-    image_lst = os.listdir(f"images/{user}")
-    desc = ""
-    for i in range(len(image_lst)):
-        print("processing image", i)
-        IMAGE_PATH = f"images/{user}/" + "page" + str(i) + ".png"
-        base64_image = encode_image(IMAGE_PATH)
 
-        content = [
-            {
-                "type": "text",
-                "text": "Please extract the details of the image very  carefully  the detail should include, the date of the bill, the amount of each item along with the quantity and the total amount in case of bills if any other document then return all the details in the same format",
-            },
+# Encode the rasterized page as a base64 string
+def encode_image(image, fmt: str = PDF_IMAGE_FORMAT, quality: int = PDF_IMAGE_QUALITY):
+    buffer = io.BytesIO()
+    if fmt == "png":
+        image.save(buffer, "PNG", optimize=True)
+    else:
+        image.save(buffer, _PIL_FORMATS.get(fmt, fmt.upper()), quality=quality)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+EXTRACTION_PROMPT = "Please extract the details of the image very  carefully  the detail should include, the date of the bill, the amount of each item along with the quantity and the total amount in case of bills if any other document then return all the details in the same format"
+
+BATCH_PROMPT = """The images are pages of the same document, numbered from 1 in the order given.
+Return the details of every page in its own section, each section starting with a line of the form
+=== Page <number> ===
+Do not skip any page."""
+
+_BATCH_SECTION = re.compile(r"^\s*=+\s*Page\s+(\d+)\s*=+\s*$", re.MULTILINE | re.IGNORECASE)
+
+
+def _extract_page(base64_image: str, fmt: str = PDF_IMAGE_FORMAT) -> str:
+    content = [
+        {
+            "type": "text",
+            "text": EXTRACTION_PROMPT,
+        },
+        {
+            "type": "image_url",
+            "image_url": {"url": f"data:image/{fmt};base64,{base64_image}"},
+        },
+    ]
+    messages = [
+        {
+            "role": "system",
+            "content": "You are a helpful assistant that responds in English.",
+        },
+        {
+            "role": "user",
+            "content": content,
+        },
+    ]
+
+    ai_message = clients.invoke(get_llm(), messages, stage="page_extraction")
+    return ai_message.content
+
+
+def _split_batch(content: str, count: int) -> Optional[List[str]]:
+    # split the response into its "=== Page k ===" sections, None if any is missing
+    matches = list(_BATCH_SECTION.finditer(content))
+    sections = {}
+    for match, following in zip(matches, matches[1:] + [None]):
+        end = following.start() if following else len(content)
+        sections[int(match.group(1))] = content[match.end():end].strip()
+    if sorted(sections) != list(range(1, count + 1)):
+        return None
+    return [sections[k] for k in range(1, count + 1)]
+
+
+def _extract_batch(base64_images: List[str], fmt: str = PDF_IMAGE_FORMAT) -> List[str]:
+    """
+    Extract several pages with a single vision request.
+
+    Falls back to one request per page when the response cannot be split
+    back into one section per page.
+
+    Parameters
+    ----------
+    base64_images : List[str]
+        Encoded page images in page order
+    """
+
+    if len(base64_images) == 1:
+        return [_extract_page(base64_images[0], fmt)]
+
+    content = [{"type": "text", "text": EXTRACTION_PROMPT + "\n\n" + BATCH_PROMPT}]
+    for k, base64_image in enumerate(base64_images, start=1):
+        content.append({"type": "text", "text": f"Page {k}"})
+        content.append(
             {
                 "type": "image_url",
-                "image_url": {"url": f"data:image/png;base64,{base64_image}"},
-            },
-        ]
-        messages = [
-            {
-                "role": "system",
-                "content": "You are a helpful assistant that responds in English.",
-            },
-            {
-                "role": "user",
-                "content": content,
-            },
-        ]
+                "image_url": {"url": f"data:image/{fmt};base64,{base64_image}"},
+            }
+        )
+    messages = [
+        {
+            "role": "system",
+            "content": "You are a helpful assistant that responds in English.",
+        },
+        {
+            "role": "user",
+            "content": content,
+        },
+    ]
+
+    ai_message = clients.invoke(get_llm(), messages, stage="page_batch_extraction")
+    sections = _split_batch(ai_message.content, len(base64_images))
+    if sections is None:
+        print("could not split batch response, extracting pages one by one")
+        metrics.inc("vision_batch_fallbacks_total")
+        return [_extract_page(base64_image, fmt) for base64_image in base64_images]
+    return sections
+
+
+def _prepare_page(image, user: str = None) -> Tuple[str, str, Optional[str]]:
+    """
+    Read a page locally when OCR is confident, otherwise encode it for the
+    vision model.
+
+    Returns
+    -------
+    The path of the page, its text or image and its pagehash digest:
+    ("blank", "") for empty pages, ("duplicate", text) for pages already
+    extracted before, ("ocr", text) for pages read locally and
+    ("vision", base64 image) for pages escalated to the vision model, which
+    are downsampled, converted to grayscale and cropped before encoding.
+    """
+
+    page_hash = None
+    try:
+        if imaging.is_blank(image):
+            metrics.inc("pages_total", path="blank")
+            return "blank", "", None
+        if pagehash.PAGE_DEDUP and user:
+            with metrics.span("page_dedup"):
+                page_hash = pagehash.digest(image)
+                text = pagehash.lookup(page_hash, user)
+            if text is not None:
+                metrics.inc("pages_total", path="duplicate")
+                return "duplicate", text, page_hash
+        if ocr.available():
+            with metrics.span("local_ocr"):
+                text = ocr.extract(image)
+            if text is not None:
+                metrics.inc("pages_total", path="ocr")
+                if page_hash is not None:
+                    pagehash.add(page_hash, user, text)
+                return "ocr", text, page_hash
+        with metrics.span("encode_image"):
+            base64_image = encode_image(imaging.optimize(image))
+    finally:
+        image.close()
+    metrics.inc("pages_total", path="vision")
+    return "vision", base64_image, page_hash
 
-        ai_message = llm.invoke(messages)
-        # print(ai_message.content)
 
-        desc += f"\n Page {i} \n" + ai_message.content
+def pdf2text(path: str, user: str, max_in_flight: int = PAGE_MAX_IN_FLIGHT):
+    """
+    Extract the text of every page of a PDF.
+
+    See extract_document for how the pages are processed.
+
+    Parameters
+    ----------
+    path : str
+        Path to the PDF
+    user : str
+        User the document belongs to
+    max_in_flight : int
+        Maximum number of pages processed at once, 1 processes pages serially
+    """
+
+    return extract_document(path, max_in_flight, user=user)["text"]
+
+
+def extract_document(
+    path: str, max_in_flight: int = PAGE_MAX_IN_FLIGHT, user: str = None
+) -> Dict:
+    """
+    Extract the text of every page of a PDF and report how each page was read.
+
+    Born-digital pages are read from the embedded text layer, blank pages are
+    skipped. Scanned pages
+    are rasterized and read with local OCR first, and only sent to the vision
+    model when the OCR confidence is too low or the page holds a ruled table.
+    With VISION_BATCH_IMAGES above 1 several such pages share one request.
+    Pages nearly identical to a page extracted before, found by perceptual
+    hash, reuse its text.
+
+    Pages are processed concurrently, with at most ``max_in_flight``
+    requests outstanding at a time, and the output is assembled in page order.
+    Results are cached by file contents, so an unchanged document is not
+    sent to the model again.
+
+    Parameters
+    ----------
+    path : str
+        Path to the PDF
+    max_in_flight : int
+        Maximum number of pages processed at once, 1 processes pages serially
+    user : str
+        User the document belongs to, enables reusing the text of pages seen before
+
+    Returns
+    -------
+    A dict with the text of the document and the path of every page, one of
+    text, blank, duplicate, ocr or vision.
+    """
+
+    return cache.cached(
+        path,
+        lambda: _extract_document(path, max_in_flight, user),
+        loader="vision",
+        prompt_version=PROMPT_VERSION,
+        dpi=PDF_DPI,
+        fmt=PDF_IMAGE_FORMAT,
+        quality=PDF_IMAGE_QUALITY,
+        blank_page_stddev=imaging.BLANK_PAGE_STDDEV,
+        max_side=imaging.VISION_MAX_SIDE,
+        grayscale=imaging.VISION_GRAYSCALE,
+        crop_margins=imaging.VISION_CROP_MARGINS,
+        ocr=ocr.available(),
+        ocr_min_confidence=ocr.OCR_MIN_CONFIDENCE,
+        ocr_min_words=ocr.OCR_MIN_WORDS,
+        ocr_escalate_tables=ocr.OCR_ESCALATE_TABLES,
+        text_layer_min_chars=textlayer.TEXT_LAYER_MIN_CHARS,
+        vision_batch_images=VISION_BATCH_IMAGES,
+    )
+
+
+def _extract_document(path: str, max_in_flight: int, user: str) -> Dict:
+    with metrics.span("pdf2text"):
+        return _extract_pages(path, max_in_flight, user)
+
+
+def _extract_pages(path: str, max_in_flight: int, user: str) -> Dict:
+    with metrics.span("text_layer"):
+        page_count, texts = textlayer.page_texts(path)
+    pages = {}
+    sources = {}
+    for i, text in texts.items():
+        pages[i] = text
+        sources[i] = "text"
+        metrics.inc("pages_total", path="text")
+    scanned = [i for i in range(page_count) if i not in texts]
+
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+        # futures of prepared pages map to ("page", i), of vision batches to
+        # ("batch", [(i, page_hash), ...])
+        pending = {}
+        batch = []
+        batch_bytes = 0
+
+        def flush():
+            nonlocal batch, batch_bytes
+            batch.sort()
+            refs = [(i, page_hash) for i, _, page_hash in batch]
+            future = executor.submit(_extract_batch, [image for _, image, _ in batch])
+            pending[future] = ("batch", refs)
+            batch = []
+            batch_bytes = 0
+
+        def collect(future):
+            nonlocal batch_bytes
+            kind, ref = pending.pop(future)
+            if kind == "batch":
+                for (i, page_hash), text in zip(ref, future.result()):
+                    pages[i] = text
+                    sources[i] = "vision"
+                    if page_hash is not None:
+                        pagehash.add(page_hash, user, text)
+                return
+            source, value, page_hash = future.result()
+            if source != "vision":
+                pages[ref] = value
+                sources[ref] = source
+                return
+            # pages escalated to the vision model are packed into batches
+            if batch and batch_bytes + len(value) > VISION_BATCH_BYTES:
+                flush()
+            batch.append((ref, value, page_hash))
+            batch_bytes += len(value)
+            if len(batch) >= VISION_BATCH_IMAGES:
+                flush()
+
+        def wait_for_slot(limit):
+            while len(pending) >= limit:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+
+        for i, image in _pdf2image(path, scanned):
+            # wait for a slot so only max_in_flight pages are held at once
+            wait_for_slot(max(1, max_in_flight))
+            print("processing image", i)
+            pending[executor.submit(_prepare_page, image, user)] = ("page", i)
+        while pending or batch:
+            if not pending:
+                flush()
+            wait_for_slot(1)
+
+    desc = ""
+    for i in range(page_count):
+        desc += f"\n Page {i} \n" + pages[i]
 
     # print(desc)
-    return desc
+    return {"text": desc, "sources": [sources[i] for i in range(page_count)]}
+
+
+def summarize_sources(sources: List[str]) -> Dict[str, int]:
+    """
+    Count the pages read by each path, e.g. {"text": 3, "vision": 1}.
+    """
+
+    counts = {}
+    for source in sources:
+        counts[source] = counts.get(source, 0) + 1
+    return counts
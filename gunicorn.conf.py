@@ -0,0 +1,40 @@
+import os
+
+# a claim request spends nearly all of its time waiting on Azure OpenAI, so
+# workers serve many requests at once with threads (gthread) or greenlets
+# (gevent) instead of one request per sync worker
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", "4"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+# requests served concurrently per worker by gthread workers, gunicorn turns
+# sync workers into gthread workers when this is above 1
+threads = int(os.getenv("GUNICORN_THREADS", "1" if worker_class == "sync" else "64"))
+# requests served concurrently per worker by gevent workers
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "500"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "600"))
+# idle connections are kept open for the polling of /jobs
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+# import the app in the master so workers share it copy-on-write, off by
+# default for gevent which has to patch the standard library first
+preload_app = os.getenv("GUNICORN_PRELOAD", "0" if worker_class == "gevent" else "1") == "1"
+
+
+def on_starting(server):
+    # load the parsing stack and models once before the workers are forked
+    if preload_app:
+        import warmup
+
+        warmup.warmup()
+
+
+def post_fork(server, worker):
+    # background threads are started in every worker rather than in the
+    # master so no thread runs in the process workers are forked from:
+    # metrics snapshots, and eviction of old uploads and extracted documents
+    # of which one worker sweeps at a time
+    import metrics
+    import workspace
+
+    metrics.start_flusher()
+    workspace.start_sweeper()
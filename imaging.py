@@ -0,0 +1,61 @@
+import os
+
+from PIL import Image, ImageStat
+
+# pages whose grayscale standard deviation is below this are treated as blank
+BLANK_PAGE_STDDEV = float(os.getenv("BLANK_PAGE_STDDEV", "1.0"))
+
+# payload settings of the page images sent to the vision model
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "1600"))
+VISION_GRAYSCALE = os.getenv("VISION_GRAYSCALE", "1") == "1"
+VISION_CROP_MARGINS = os.getenv("VISION_CROP_MARGINS", "1") == "1"
+
+_MARGIN_PADDING = 16
+
+
+def is_blank(image: Image.Image) -> bool:
+    """
+    Whether a page is (nearly) empty, e.g. a separator sheet or a scanned back side.
+
+    Parameters
+    ----------
+    image : PIL.Image
+        Rasterized page
+    """
+
+    small = image.convert("L")
+    small.thumbnail((512, 512))
+    return ImageStat.Stat(small).stddev[0] < BLANK_PAGE_STDDEV
+
+
+def optimize(image: Image.Image) -> Image.Image:
+    """
+    Shrink a page before it is encoded for the vision model.
+
+    The page is converted to grayscale, white margins are cropped and the
+    page is downsampled so its longest side is at most VISION_MAX_SIDE.
+
+    Parameters
+    ----------
+    image : PIL.Image
+        Rasterized page
+    """
+
+    gray = image.convert("L")
+    result = gray if VISION_GRAYSCALE else image.convert("RGB")
+    if VISION_CROP_MARGINS:
+        # anything darker than light gray counts as content
+        bbox = gray.point(lambda p: 255 if p < 200 else 0).getbbox()
+        if bbox:
+            left, top, right, bottom = bbox
+            result = result.crop(
+                (
+                    max(0, left - _MARGIN_PADDING),
+                    max(0, top - _MARGIN_PADDING),
+                    min(gray.width, right + _MARGIN_PADDING),
+                    min(gray.height, bottom + _MARGIN_PADDING),
+                )
+            )
+    if max(result.size) > VISION_MAX_SIDE:
+        result.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE), Image.LANCZOS)
+    return result
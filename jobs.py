@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import processes
+from main import PolicyQuestion
+from extract import summarize_sources
+
+# persistent job table and the number of documents processed at once per worker
+JOBS_DB = os.getenv("JOBS_DB", "jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS)
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(JOBS_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            user TEXT,
+            document TEXT,
+            path TEXT,
+            status TEXT,
+            error TEXT,
+            result TEXT,
+            pid INTEGER,
+            created REAL,
+            updated REAL
+        )"""
+    )
+    return conn
+
+
+def _update(job_id: str, **fields):
+    fields["updated"] = time.time()
+    columns = ", ".join(f"{k} = ?" for k in fields)
+    with _connect() as conn:
+        conn.execute(
+            f"UPDATE jobs SET {columns} WHERE id = ?", [*fields.values(), job_id]
+        )
+
+
+def _to_dict(row: sqlite3.Row) -> Dict:
+    job = dict(row)
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    # jobs of a worker that died will never finish
+    if job["status"] in ("queued", "running") and not processes.alive(job["pid"]):
+        job["status"] = "failed"
+        job["error"] = "worker stopped before the job finished"
+    return job
+
+
+def process_document(user: str, document: str, path: str) -> Dict:
+    """
+    Extract the text of an uploaded document.
+
+    For documents read page by page the result reports which path read each
+    page, the embedded text layer, local OCR or the vision model, and which
+    pages were skipped as blank.
+
+    Parameters
+    ----------
+    user : str
+        User who uploaded the document
+    document : str
+        Kind of the document, e.g. bills or reports
+    path : str
+        Path of the uploaded file
+    """
+
+    user_obj = PolicyQuestion(user)
+    if document == "policy" or document == "discharge":
+        # partitioned during the assessment, parse now so it is served from the cache
+        user_obj._load_chunks(path)
+        return {}
+    if document == "reports":
+        user_obj.read_ocr(path, file_name=document)
+        return {}
+    sources = user_obj.load_doc(path, file_name=document)
+    return {"pages": sources, "summary": summarize_sources(sources)}
+
+
+def _run(job_id: str, user: str, document: str, path: str):
+    _update(job_id, status="running")
+    try:
+        result = process_document(user, document, path)
+    except Exception as e:
+        print(e)
+        _update(job_id, status="failed", error=str(e))
+        return
+    _update(job_id, status="done", result=json.dumps(result))
+
+
+def submit(user: str, document: str, path: str) -> str:
+    """
+    Queue an uploaded document for processing and return the job id.
+    """
+
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with _connect() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, user, document, path, status, pid, created, updated)"
+            " VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+            (job_id, user, document, path, os.getpid(), now, now),
+        )
+    _executor.submit(_run, job_id, user, document, path)
+    return job_id
+
+
+def get(job_id: str) -> Optional[Dict]:
+    """
+    Return the job with the given id or None if it does not exist.
+    """
+
+    with _connect() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return _to_dict(row) if row else None
+
+
+def pending(user: str) -> List[Dict]:
+    """
+    Return the jobs of the user which have not finished yet.
+    """
+
+    with _connect() as conn:
+        rows = conn.execute(
+            "SELECT * FROM jobs WHERE user = ? AND status IN ('queued', 'running')",
+            (user,),
+        ).fetchall()
+    return [job for job in map(_to_dict, rows) if job["status"] != "failed"]
@@ -1,15 +1,18 @@
 import os
 from dotenv.main import load_dotenv
-from langchain_openai import AzureChatOpenAI
-from langchain_unstructured import UnstructuredLoader
-from unstructured.partition.auto import partition
-import nltk
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import PromptTemplate
-from langchain_openai import OpenAI
-from extract import pdf2text
+from extract import pdf2text, extract_document
+import cache
+import retrieval
+import reconcile
+import parsing
+import clients
+import metrics
+import workspace
+from clients import get_llm
 import json
-from typing import List
+import hashlib
+import threading
+from typing import Dict, List, Optional
 
 load_dotenv()
 os.environ["OPENAI_API_TYPE"] = "azure"
@@ -30,6 +33,69 @@ policy_questions = [
     "Policy running time (from data and to date)",
 ]
 
+# policy rules looked up for the bill reimbursement
+bill_reimbursement_queries = [
+    "Maximum reimbursement limit sum insured",
+    "Medicines drugs pharmacy consumables covered",
+    "Non medical expenses excluded items not payable",
+    "Room rent limit sub-limits capping",
+    "co-payment deductible",
+    "Pre hospitalization and post hospitalization expenses",
+]
+
+# chunking parameters of the unstructured loader, part of the cache key
+CHUNKING_STRATEGY = "basic"
+MAX_CHARACTERS = 1000
+
+# keys every section answer must have, see parsing.validate
+SECTION_SCHEMAS = {
+    "policy": dict.fromkeys(
+        [
+            "policy-holder-name",
+            "running-time",
+            "insurer",
+            "start-date",
+            "ped",
+            "first-diagnosis",
+            "ongoing-treatment-disease",
+            "ongoing-disease-covered",
+            "ped-waiting-over",
+            "total-cover-amount",
+            "co-payment",
+            "pre-hospitalization-days",
+            "post-hospitalization-days",
+            "fraud",
+            "remarks",
+            "summary-policy-holder",
+        ]
+    ),
+    "bills": {
+        "pharmacy-name": None,
+        "items": list,
+        "printed-total": None,
+        "max-reimbursement": None,
+        "co-payment": None,
+    },
+    "discharge": dict.fromkeys(["doctor-name", "hospital-name", "reason"]),
+    "reports": {"reports-tests": None},
+    "claim": {"reimbursement-sought": None},
+    "prescriptions": {"medicines-prescribed": None},
+}
+SECTION_SCHEMAS["combined"] = {
+    name: SECTION_SCHEMAS[name] for name in ["policy", "bills", "discharge"]
+}
+
+# answers that do not parse are sent back to the model with a short repair
+# prompt at most this many times
+PARSE_REPAIR_ATTEMPTS = int(os.getenv("PARSE_REPAIR_ATTEMPTS", "1"))
+
+# combined requests for the policy, bills and discharge sections larger than
+# this many characters fall back to one request per section
+COMBINED_MAX_CHARS = int(os.getenv("COMBINED_MAX_CHARS", "60000"))
+
+# guards read-modify-write of the persisted policy state
+_policy_lock = threading.Lock()
+
 discharge_summary_questions = [
     "Doctors name",
     "Hospital name",
@@ -49,17 +115,148 @@ class PolicyQuestion:
         """
 
         self.user = user
-        self.llm = AzureChatOpenAI(
-            openai_api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-            azure_deployment=os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME"),
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-            temperature=0.8,
-            # print(llm.invoke("hello"))
-        )
+        self.data = None
+        self.policy_hash = None
+        # the client is shared by the whole worker process
+        self.llm = get_llm()
 
     def __str__(self):
         return self.user
 
+    def _load_chunks(self, path: str) -> List[str]:
+        """
+        Partition a document into text chunks, reusing the cached result
+        when the same file was partitioned before.
+
+        Parameters
+        ----------
+        path : str
+            Path to the document
+        """
+
+        def load():
+            # imported on first use, gunicorn loads it before forking via warmup.py
+            from langchain_unstructured import UnstructuredLoader
+
+            loader = UnstructuredLoader(
+                path,
+                chunking_strategy=CHUNKING_STRATEGY,
+                max_characters=MAX_CHARACTERS,
+                include_orig_elements=False,
+            )
+            with metrics.span("unstructured_load"):
+                return [chunk.page_content for chunk in loader.load()]
+
+        return cache.cached(
+            path,
+            load,
+            loader="unstructured",
+            chunking_strategy=CHUNKING_STRATEGY,
+            max_characters=MAX_CHARACTERS,
+        )
+
+    def _policy_state_path(self) -> str:
+        return f"docs/{self.user}/policy.json"
+
+    def _read_policy_state(self) -> dict:
+        try:
+            with open(self._policy_state_path(), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_policy_state(self, state: dict):
+        workspace.write_text(self._policy_state_path(), json.dumps(state))
+
+    def load_policy(self, path: str = None) -> List[str]:
+        """
+        Load the parsed policy chunks, reusing the policy persisted for the user.
+
+        The chunks are stored in docs/<user>/policy.json together with the hash
+        of the policy document, so any PolicyQuestion of the user can reuse them.
+
+        Parameters
+        ----------
+        path : str
+            Path to the policy document, the persisted policy is used if not given
+        """
+
+        if path is None:
+            if self.data is not None:
+                return self.data
+            state = self._read_policy_state()
+            if state:
+                self.data = state["chunks"]
+                self.policy_hash = state["hash"]
+                return self.data
+            path = f"static/docs/{self.user}/policy.pdf"
+
+        doc_hash = cache.file_hash(path)
+        state = self._read_policy_state()
+        if state.get("hash") != doc_hash:
+            chunks = self._load_chunks(path)
+            with _policy_lock:
+                state = {"hash": doc_hash, "chunks": chunks, "answers": {}}
+                self._write_policy_state(state)
+        self.data = state["chunks"]
+        self.policy_hash = doc_hash
+        return self.data
+
+    def _policy_context(self, queries: List[str]) -> str:
+        """
+        Policy text relevant to the queries, limited to POLICY_TOKEN_BUDGET.
+
+        Parameters
+        ----------
+        queries : List[str]
+            Questions the prompt asks about the policy
+        """
+
+        chunks = retrieval.select_chunks(self.policy_hash, self.data, queries)
+        print(f"using {len(chunks)} of {len(self.data)} policy chunks")
+        additinal_prompt = """"""
+        for i in range(len(chunks)):
+            additinal_prompt += chunks[i]
+            additinal_prompt += "\n"
+        return additinal_prompt
+
+    def _ask(self, prompt: str, section: str) -> dict:
+        """
+        Send a prompt and parse the JSON answer of a section.
+
+        An answer which does not parse or misses keys of the section schema is
+        not asked again in full, only the answer itself is sent back with a
+        short repair prompt.
+
+        Parameters
+        ----------
+        prompt : str
+            Prompt of the section
+        section : str
+            Section asked, selects the schema and labels the metrics
+        """
+
+        schema = SECTION_SCHEMAS[section]
+        content = clients.invoke(self.llm, prompt, stage=section).content
+        for attempt in range(PARSE_REPAIR_ATTEMPTS + 1):
+            print(content)
+            try:
+                with metrics.span("json_parse", section=section):
+                    return parsing.parse(content, schema)
+            except parsing.ParseError as e:
+                if attempt == PARSE_REPAIR_ATTEMPTS:
+                    raise
+                print(f"could not parse the {section} answer: {e}")
+                metrics.inc("json_repairs_total", section=section)
+                repair_prompt = f"""Your previous answer could not be parsed: {e}
+
+        Reply with only the corrected JSON object in this format, keys and strings in double quotes, no trailing commas, null for unknown values:
+        {parsing.skeleton(schema)}
+
+        Previous answer:
+        {content}"""
+                content = clients.invoke(self.llm, repair_prompt, stage=f"{section}_repair").content
+
     def read_ocr(self, path: str, file_name: str):
         """
         Read OCR and save it in the docs directory.
@@ -72,25 +269,16 @@ class PolicyQuestion:
             Name of the document
         """
 
-        os.makedirs(f"docs/{self.user}", exist_ok=True)
-        loader = UnstructuredLoader(
-            path,
-            chunking_strategy="basic",
-            max_characters=1000,
-            include_orig_elements=False,
-        )
-        data = loader.load()
+        data = self._load_chunks(path)
         additinal_prompt = """"""
         for i in range(len(data)):
-            additinal_prompt += data[i].page_content
+            additinal_prompt += data[i]
             additinal_prompt += "\n"
-        os.makedirs(f"docs/{self.user}", exist_ok=True)
-        with open("docs/" + self.user + f"/{file_name}.txt", "w") as f:
-            f.write(additinal_prompt)
+        workspace.write_text(f"docs/{self.user}/{file_name}.txt", additinal_prompt)
 
         print(f"loaded {file_name}")
 
-    def load_doc(self, path: str, file_name: str):
+    def load_doc(self, path: str, file_name: str) -> List[str]:
         """
         Load document and save it in the docs directory.
 
@@ -100,14 +288,19 @@ class PolicyQuestion:
             Path to the document
         file_name : str
             Name of the document
+
+        Returns
+        -------
+        The path which read each page, one of text, blank, duplicate, ocr
+        or vision.
         """
 
-        details = pdf2text(path, self.user)
+        document = extract_document(path, user=self.user)
+        details = document["text"]
 
-        os.makedirs(f"docs/{self.user}", exist_ok=True)
-        with open("docs/" + self.user + f"/{file_name}.txt", "w") as f:
-            f.write(details)
+        workspace.write_text(f"docs/{self.user}/{file_name}.txt", details)
         print(f"loaded {file_name}")
+        return document["sources"]
 
     def load_bill(self, path: str):
         """
@@ -173,18 +366,14 @@ class PolicyQuestion:
         Policy Document:
         """
 
-        loader = UnstructuredLoader(
-            path,
-            chunking_strategy="basic",
-            max_characters=1000,
-            include_orig_elements=False,
-        )
-        self.data = loader.load()
+        self.load_policy(path)
+        answers_key = hashlib.sha256(additional_data.encode("utf-8")).hexdigest()
+        answers = self._read_policy_state().get("answers", {})
+        if answers_key in answers:
+            print("reusing persisted policy answers")
+            return answers[answers_key]
 
-        additinal_prompt = """"""
-        for i in range(len(self.data)):
-            additinal_prompt += self.data[i].page_content
-            additinal_prompt += "\n"
+        additinal_prompt = self._policy_context(policy_questions)
 
         prompt = prompt + additinal_prompt + "\n".join(policy_questions)
 
@@ -207,61 +396,58 @@ class PolicyQuestion:
             "remarks": <value- this will be a summary of the policy>,
             "summary-policy-holder": <value: this will be a summary of the policy Holder>
         }"""
-        response = self.llm.invoke(prompt + suffix)
-        print(response.content)
-        response = response.content.replace("```json", "")
-        response = response.replace("```", "")
-        # response = response.replace("'",'"')
-
-        
-        print(response)
-
-        response = json.loads(response, strict=False)
+        response = self._ask(prompt + suffix, "policy")
+        with _policy_lock:
+            state = self._read_policy_state()
+            if state.get("hash") == cache.file_hash(path):
+                state.setdefault("answers", {})[answers_key] = response
+                self._write_policy_state(state)
         # print(response.)
         return response
 
-    def get_bill_details(self):
+    def get_bill_details(self, policy_path: str = None):
         """
         Get bill details from the document.
+
+        Parameters
+        ----------
+        policy_path : str
+            Path to the policy document, the persisted policy is used if not given
         """
 
         desc = ""
         with open("docs/" + self.user + "/bills.txt", "r") as f:
             desc = f.read()
         prompt = """You are an expert in Insurance policy assessment.
-        You are given details of the bill and you need to extract the total of rembursement 
-        
-        Things to remember:
-        1. Give the total of resmbursement (calculate the total of reimbursible items)
-        2. Take your time and accurately calculate the total of reimbursible items
-        3. Remburseable items are as only the medical expenses like medicines and not non medical expenses
-        4. Give the total of reimbursible items and not the total of non reimbursible items saperately also mention the non reimbursible items
+        You are given details of the bill and you need to extract every line item of the bill.
 
-        Note: Give your answers very carefully and accurately it is important to give the total of reimbursible items very accurately
-        
-        Calculate the total very carefully and accurately
+        Things to remember:
+        1. List every line item exactly as printed, do not add up or calculate anything
+        2. qty, unit-price and amount are numbers as printed on the bill, null if not printed
+        3. category is one of """ + ", ".join(reconcile.CATEGORIES) + """, medicines and other medical expenses are never non-medical
+        4. From the policy document give the maximum reimbursement amount and the co-payment percentage, null if not mentioned
 
         give short and crisp response in English
         give a json response in the following format:
-        
+
         Always enclose the keys in double quotes
 
         ```json
-        {   
+        {
             "pharmacy-name": <value>,
-            "total": <value>,
-            "non-reimbursible": <value>,
-            "reimbursible": <value>,
-            "deductions": <value- detailed description of non-reimbursible and reimbursible in english only dont create any dictionary for it>,
+            "items": [
+                {"description": <value>, "qty": <number>, "unit-price": <number>, "amount": <number>, "category": <value>}
+            ],
+            "printed-total": <number - the total printed on the bill>,
+            "max-reimbursement": <number>,
+            "co-payment": <number - percentage>
         }
         ```
         Bill details:
         """ + desc
 
-        additinal_prompt = """"""
-        for i in range(len(self.data)):
-            additinal_prompt += self.data[i].page_content
-            additinal_prompt += "\n"
+        self.load_policy(policy_path)
+        additinal_prompt = self._policy_context(bill_reimbursement_queries)
 
         prompt = (
             prompt
@@ -269,15 +455,10 @@ class PolicyQuestion:
             + additinal_prompt
         )
 
-        response = self.llm.invoke(prompt)
-        response = response.content.replace("```json", "")
-        response = response.replace("```", "")
-        response = response.replace("``", "")
-        # response = response.replace("'",'"')
-        
-        print(response)
-        response = json.loads(response, strict=False)
-        return response
+        response = self._ask(prompt, "bills")
+        # totals and policy limits are computed locally from the line items
+        with metrics.span("reconcile", section="bills"):
+            return reconcile.reconcile_bill(response)
 
     def get_discharge_details(self, path: str) -> dict:
         """
@@ -288,17 +469,11 @@ class PolicyQuestion:
         questions = "\n".join(discharge_summary_questions)
         # with open("docs/" + self.user + "/discharge.txt", "r") as f:
         #     desc = f.read()
-        loader = UnstructuredLoader(
-            path,
-            chunking_strategy="basic",
-            max_characters=1000,
-            include_orig_elements=False,
-        )
-        data = loader.load()
+        data = self._load_chunks(path)
 
         additinal_prompt = """"""
         for i in range(len(data)):
-            additinal_prompt += data[i].page_content
+            additinal_prompt += data[i]
             additinal_prompt += "\n"
 
         prompt = (
@@ -329,18 +504,7 @@ Always enclose the keys in double quotes
 """
         )
 
-        response = self.llm.invoke(prompt)
-        response = response.content.replace("```json", "")
-        response = response.replace("```", "")
-        # response = response.replace("'",'"')
-
-        # response = response.replace("``", "")
-        
-        print(response)
-
-        response = json.loads(response, strict=False)
-        # print(response.content)
-        return response
+        return self._ask(prompt, "discharge")
 
     def get_report_details(self, path: str) -> dict:
         """
@@ -376,14 +540,7 @@ Always enclose the keys in double quotes
         """
         )
 
-        response = self.llm.invoke(prompt)
-        response = response.content.replace("```json", "")
-        response = response.replace("```", "")
-        # response = response.replace("``", "")
-
-        print(response)
-        response = json.loads(response, strict=False)
-        return response
+        return self._ask(prompt, "reports")
 
     def get_claim_details(self, file_name: str):
         """
@@ -419,18 +576,7 @@ Always enclose the keys in double quotes
         ```
         """
 
-        response = self.llm.invoke(prompt)
-
-        response = response.content.replace("```json", "")
-        response = response.replace("```", "")
-        # response = response.replace("'",'"')
-
-        # response = response.replace('"', "'")
-        
-        print(response)
-        response = json.loads(response, strict=False)
-        # print(response.content)
-        return response
+        return self._ask(prompt, "claim")
 
     def get_prescription_details(self, file_name: str):
         """
@@ -470,16 +616,121 @@ Always enclose the keys in double quotes
         """
         )
 
-        response = self.llm.invoke(prompt)
-        response = response.content.replace("```json", "")
-        response = response.replace("```", "")
-        # response = response.replace("'",'"')
-        # response = response.replace('"', "'")
-        
-        print(response)
-        response = json.loads(response, strict=False)
-        # print(response.content)
-        return response
+        return self._ask(prompt, "prescriptions")
+
+    def get_combined_details(
+        self, policy_path: str, discharge_path: str, additional_data: str = ""
+    ) -> Optional[Dict[str, dict]]:
+        """
+        Get the policy, bill and discharge details with a single request.
+
+        The policy text is selected once for the policy and bill questions and
+        shared by all three sections, the bill line items are reconciled
+        locally like in get_bill_details.
+
+        Parameters
+        ----------
+        policy_path : str
+            Path to the policy document
+        discharge_path : str
+            Path to the discharge summary
+        additional_data : str
+            Details provided by the user in the claim form
+
+        Returns
+        -------
+        The answers of the policy, bills and discharge sections, or None if the
+        request would exceed COMBINED_MAX_CHARS and the sections have to be
+        asked one by one.
+        """
+
+        self.load_policy(policy_path)
+        policy = self._policy_context(policy_questions + bill_reimbursement_queries)
+        with open("docs/" + self.user + "/bills.txt", "r") as f:
+            bills = f.read()
+        discharge = "\n".join(self._load_chunks(discharge_path))
+        policy_prompt = "\n".join(policy_questions)
+        discharge_prompt = "\n".join(discharge_summary_questions)
+        categories = ", ".join(reconcile.CATEGORIES)
+
+        prompt = f"""You are an expert in Insurance policy assessment.
+        You are given a policy document, the bill and the discharge summary of a claim and additional data provided by the user.
+        Answer the questions of every part from the documents, if the answer is not in the documents give answer as 'N/A'.
+
+        Policy questions, answer from the policy document and the additional data, give reason for the answers:
+        [important] Note: the total coverage amount of the policy should be calculated including all the premium and bonus etc.
+        {policy_prompt}
+
+        Bill, list every line item exactly as printed without adding up or calculating anything,
+        qty, unit-price and amount are numbers as printed on the bill, null if not printed,
+        category is one of {categories}, medicines and other medical expenses are never non-medical,
+        give the maximum reimbursement amount and the co-payment percentage from the policy document, null if not mentioned.
+
+        Discharge summary questions:
+        {discharge_prompt}
+
+        additional data:
+        {additional_data}
+
+        Policy Document:
+        {policy}
+
+        Bill details:
+        {bills}
+
+        Discharge summary details:
+        {discharge}
+        """
+        suffix = """\n\nAnswer in json format with keys enclosed in double quotes:
+        {
+            "policy": {
+                "policy-holder-name": <value>,
+                "running-time": <value - running from dd/mm/yyyy to dd/mm/yyyy >,
+                "insurer": <value>,
+                "start-date": <value>,
+                "ped": <value>,
+                "first-diagnosis": <value>,
+                "ongoing-treatment-disease": <value>,
+                "ongoing-disease-covered": <value>,
+                "ped-waiting-over": <value>,
+                "total-cover-amount": <value>,
+                "co-payment": <value>,
+                "pre-hospitalization-days": <value>,
+                "post-hospitalization-days": <value>,
+                "fraud": <value>,
+                "remarks": <value- this will be a summary of the policy>,
+                "summary-policy-holder": <value: this will be a summary of the policy Holder>
+            },
+            "bills": {
+                "pharmacy-name": <value>,
+                "items": [
+                    {"description": <value>, "qty": <number>, "unit-price": <number>, "amount": <number>, "category": <value>}
+                ],
+                "printed-total": <number - the total printed on the bill>,
+                "max-reimbursement": <number>,
+                "co-payment": <number - percentage>
+            },
+            "discharge": {
+                "doctor-name": <value>,
+                "hospital-name": <value>,
+                "reason": <value>
+            }
+        }"""
+        prompt = prompt + suffix
+        if len(prompt) > COMBINED_MAX_CHARS:
+            print(f"combined request of {len(prompt)} characters too large, asking section by section")
+            metrics.inc("combined_requests_total", result="too_large")
+            return None
+
+        response = self._ask(prompt, "combined")
+        metrics.inc("combined_requests_total", result="sent")
+        with metrics.span("reconcile", section="bills"):
+            bills = reconcile.reconcile_bill(response["bills"])
+        return {
+            "policy": response["policy"],
+            "bills": bills,
+            "discharge": response["discharge"],
+        }
 
 
 # obj = PolicyQuestion("user")
@@ -0,0 +1,288 @@
+import os
+import json
+import time
+import fcntl
+import atexit
+import threading
+from contextlib import contextmanager
+from typing import Dict
+
+import processes
+
+# every worker process writes its metrics here so /metrics can merge them
+METRICS_DIR = os.getenv("METRICS_DIR", "metrics")
+# seconds between snapshots of the metrics of a worker, the worker serving
+# /metrics always writes its own snapshot first
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+BUCKETS = {
+    "seconds": [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300],
+    "chars": [100, 1000, 5000, 10000, 25000, 50000, 100000, 250000, 1000000],
+}
+
+HELP = {
+    "stage_duration_seconds": "Wall time of a pipeline stage",
+    "route_duration_seconds": "Wall time of an HTTP request",
+    "llm_duration_seconds": "Wall time of an LLM call",
+    "llm_prompt_chars": "Characters sent to the LLM per call",
+    "llm_response_chars": "Characters received from the LLM per call",
+    "llm_tokens_total": "Tokens reported by the LLM",
+    "pages_total": "Document pages by the path that extracted them",
+    "page_dedup_total": "Lookups of repeated pages by result",
+    "sections_total": "Claim assessment sections by whether they were computed or reused",
+    "combined_requests_total": "Combined policy, bill and discharge requests by whether they were sent",
+    "json_repairs_total": "Repair prompts sent for section answers that did not parse",
+    "llm_queue_seconds": "Time an LLM call waited for the shared rate limit",
+    "llm_throttled_total": "429 responses of the LLM deployment",
+    "workspaces_evicted_total": "User workspaces deleted by age or to fit the disk budget",
+}
+
+_histograms = {}
+_counters = {}
+_lock = threading.Lock()
+# keeps snapshots written in the order they were taken
+_write_lock = threading.Lock()
+_dirty = False
+_flusher_pid = None
+# summed snapshots of worker processes which exited
+_ARCHIVE = "archive.json"
+
+
+def _key(name: str, labels: Dict) -> str:
+    return json.dumps([name, sorted(labels.items())])
+
+
+def flush():
+    """
+    Write the snapshot of this process if anything changed since the last one.
+    """
+
+    global _dirty
+    with _write_lock:
+        with _lock:
+            if not _dirty:
+                return
+            snapshot = json.dumps({"histograms": _histograms, "counters": _counters})
+            _dirty = False
+        # written outside _lock, updates never wait for the disk
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            f.write(snapshot)
+        os.replace(path + ".tmp", path)
+
+
+atexit.register(flush)
+
+
+def _flusher():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            print(f"writing metrics failed: {e}")
+
+
+def start_flusher():
+    """
+    Write the snapshot of this process every METRICS_FLUSH_INTERVAL seconds
+    in a background thread. Does nothing if the thread already runs.
+    """
+
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    _flusher_pid = os.getpid()
+    threading.Thread(target=_flusher, name="metrics-flusher", daemon=True).start()
+
+
+def observe(name: str, value: float, unit: str = "seconds", **labels):
+    """
+    Record a value in a histogram.
+
+    Parameters
+    ----------
+    name : str
+        Name of the histogram
+    value : float
+        Observed value
+    unit : str
+        Bucket layout of the histogram, seconds or chars
+    labels :
+        Labels of the series
+    """
+
+    global _dirty
+    key = _key(name, labels)
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = {
+                "le": BUCKETS[unit],
+                "buckets": [0] * len(BUCKETS[unit]),
+                "sum": 0.0,
+                "count": 0,
+            }
+        hist = _histograms[key]
+        for i, le in enumerate(hist["le"]):
+            if value <= le:
+                hist["buckets"][i] += 1
+        hist["sum"] += value
+        hist["count"] += 1
+        _dirty = True
+
+
+def inc(name: str, value: float = 1, **labels):
+    """
+    Increment a counter.
+    """
+
+    global _dirty
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+        _dirty = True
+
+
+@contextmanager
+def span(stage: str, **labels):
+    """
+    Time the enclosed block as a pipeline stage.
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("stage_duration_seconds", time.perf_counter() - start, stage=stage, **labels)
+
+
+def record_llm(stage: str, duration: float, prompt_chars: int, response):
+    """
+    Record the duration, sizes and token usage of an LLM call.
+
+    Parameters
+    ----------
+    stage : str
+        Pipeline stage which made the call
+    duration : float
+        Wall time of the call in seconds
+    prompt_chars : int
+        Size of the prompt in characters
+    response : AIMessage
+        Response of the model
+    """
+
+    observe("llm_duration_seconds", duration, stage=stage)
+    observe("llm_prompt_chars", prompt_chars, unit="chars", stage=stage)
+    observe("llm_response_chars", len(response.content), unit="chars", stage=stage)
+    usage = getattr(response, "usage_metadata", None) or {}
+    if not usage:
+        token_usage = response.response_metadata.get("token_usage") or {}
+        usage = {
+            "input_tokens": token_usage.get("prompt_tokens", 0),
+            "output_tokens": token_usage.get("completion_tokens", 0),
+        }
+    for kind in ["input_tokens", "output_tokens"]:
+        if usage.get(kind):
+            inc("llm_tokens_total", usage[kind], stage=stage, kind=kind.split("_")[0])
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def _read(path: str):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _merge(total: Dict, snapshot: Dict):
+    for key, hist in snapshot["histograms"].items():
+        merged = total["histograms"].setdefault(
+            key, {"le": hist["le"], "buckets": [0] * len(hist["le"]), "sum": 0.0, "count": 0}
+        )
+        merged["buckets"] = [a + b for a, b in zip(merged["buckets"], hist["buckets"])]
+        merged["sum"] += hist["sum"]
+        merged["count"] += hist["count"]
+    for key, value in snapshot["counters"].items():
+        total["counters"][key] = total["counters"].get(key, 0) + value
+
+
+def _archive_dead():
+    # fold the snapshots of workers which exited into archive.json, so the
+    # merged totals never go down when gunicorn replaces a worker, called
+    # with the archive lock held
+    dead = [
+        name
+        for name in os.listdir(METRICS_DIR)
+        if name.endswith(".json")
+        and name[: -len(".json")].isdigit()
+        and not processes.alive(int(name[: -len(".json")]))
+    ]
+    if not dead:
+        return
+    path = os.path.join(METRICS_DIR, _ARCHIVE)
+    archive = _read(path) or {"histograms": {}, "counters": {}}
+    for name in dead:
+        snapshot = _read(os.path.join(METRICS_DIR, name))
+        if snapshot is not None:
+            _merge(archive, snapshot)
+    with open(path + ".tmp", "w") as f:
+        json.dump(archive, f)
+    os.replace(path + ".tmp", path)
+    for name in dead:
+        os.remove(os.path.join(METRICS_DIR, name))
+
+
+def render() -> str:
+    """
+    Render the metrics of all worker processes in the Prometheus text format.
+
+    The snapshots of workers which exited are kept summed in one archive.
+    """
+
+    flush()
+    total = {"histograms": {}, "counters": {}}
+    if os.path.isdir(METRICS_DIR):
+        # one worker at a time, so none reads a snapshot that another has
+        # already added to the archive
+        with open(os.path.join(METRICS_DIR, ".archive.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            _archive_dead()
+            for name in os.listdir(METRICS_DIR):
+                if not name.endswith(".json"):
+                    continue
+                snapshot = _read(os.path.join(METRICS_DIR, name))
+                if snapshot is not None:
+                    _merge(total, snapshot)
+    histograms = total["histograms"]
+    counters = total["counters"]
+
+    lines = []
+    seen = set()
+    for key in sorted(histograms):
+        name, labels = json.loads(key)
+        hist = histograms[key]
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+        for le, count in zip(hist["le"], hist["buckets"]):
+            lines.append(f"{name}_bucket{_format_labels(labels + [['le', le]])} {count}")
+        lines.append(f"{name}_bucket{_format_labels(labels + [['le', '+Inf']])} {hist['count']}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {hist['sum']}")
+        lines.append(f"{name}_count{_format_labels(labels)} {hist['count']}")
+    for key in sorted(counters):
+        name, labels = json.loads(key)
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_format_labels(labels)} {counters[key]}")
+    return "\n".join(lines) + "\n"
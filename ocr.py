@@ -0,0 +1,137 @@
+import os
+from functools import lru_cache
+from typing import Optional, Tuple
+
+try:
+    import cv2
+    import numpy as np
+    import pytesseract
+except ImportError:  # the local fast path is skipped without OpenCV/Tesseract
+    cv2 = None
+
+# pages are read with Tesseract first and only sent to the vision model
+# when the local result is not trustworthy
+OCR_FAST_PATH = os.getenv("OCR_FAST_PATH", "1") == "1"
+OCR_MIN_CONFIDENCE = float(os.getenv("OCR_MIN_CONFIDENCE", "80"))
+OCR_MIN_WORDS = int(os.getenv("OCR_MIN_WORDS", "20"))
+OCR_ESCALATE_TABLES = os.getenv("OCR_ESCALATE_TABLES", "1") == "1"
+OCR_LANG = os.getenv("OCR_LANG", "eng")
+
+
+@lru_cache(maxsize=1)
+def available() -> bool:
+    """
+    Whether the local OCR fast path can be used.
+    """
+
+    if not OCR_FAST_PATH or cv2 is None:
+        return False
+    try:
+        pytesseract.get_tesseract_version()
+    except Exception:
+        return False
+    return True
+
+
+def preprocess(image) -> "np.ndarray":
+    """
+    Convert a page to a deskewed black on white binary image.
+
+    Parameters
+    ----------
+    image : PIL.Image
+        Rasterized page
+    """
+
+    gray = cv2.cvtColor(np.array(image.convert("RGB")), cv2.COLOR_RGB2GRAY)
+    # foreground (text) is white in the inverted threshold used to find the skew
+    inverted = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+    coords = cv2.findNonZero(inverted)
+    if coords is not None:
+        angle = cv2.minAreaRect(coords)[-1]
+        if angle > 45:
+            angle -= 90
+        elif angle < -45:
+            angle += 90
+        if 0.5 < abs(angle) < 15:
+            h, w = gray.shape
+            matrix = cv2.getRotationMatrix2D((w // 2, h // 2), angle, 1.0)
+            gray = cv2.warpAffine(
+                gray, matrix, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE
+            )
+    return cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+
+
+def has_table(binary: "np.ndarray") -> bool:
+    """
+    Detect ruled tables, which Tesseract reads without their row structure.
+
+    Parameters
+    ----------
+    binary : np.ndarray
+        Black on white page from preprocess
+    """
+
+    inverted = 255 - binary
+    h, w = binary.shape
+    horizontal = cv2.morphologyEx(
+        inverted, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (max(1, w // 20), 1))
+    )
+    vertical = cv2.morphologyEx(
+        inverted, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (1, max(1, h // 40)))
+    )
+    h_lines = len(cv2.findContours(horizontal, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0])
+    v_lines = len(cv2.findContours(vertical, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0])
+    return h_lines >= 3 and v_lines >= 3
+
+
+def read_page(image) -> Tuple[str, float, int, bool]:
+    """
+    Read a page with Tesseract.
+
+    Parameters
+    ----------
+    image : PIL.Image
+        Rasterized page
+
+    Returns
+    -------
+    The text, the mean word confidence, the number of words and whether a
+    ruled table was detected.
+    """
+
+    binary = preprocess(image)
+    data = pytesseract.image_to_data(
+        binary, lang=OCR_LANG, output_type=pytesseract.Output.DICT
+    )
+    lines = {}
+    confidences = []
+    for i, word in enumerate(data["text"]):
+        conf = float(data["conf"][i])
+        if conf < 0 or not word.strip():
+            continue
+        confidences.append(conf)
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        lines.setdefault(key, []).append(word)
+    text = "\n".join(" ".join(words) for words in lines.values())
+    confidence = sum(confidences) / len(confidences) if confidences else 0.0
+    return text, confidence, len(confidences), has_table(binary)
+
+
+def extract(image) -> Optional[str]:
+    """
+    Return the text of a page if local OCR read it reliably, None otherwise.
+
+    Parameters
+    ----------
+    image : PIL.Image
+        Rasterized page
+    """
+
+    text, confidence, words, table = read_page(image)
+    print(f"ocr confidence {confidence:.1f} words {words} table {table}")
+    if confidence < OCR_MIN_CONFIDENCE or words < OCR_MIN_WORDS:
+        return None
+    if table and OCR_ESCALATE_TABLES:
+        return None
+    return text
@@ -0,0 +1,119 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import Optional
+
+from PIL import Image
+
+import metrics
+
+# repeated pages reuse the text extracted for an earlier copy, of the same
+# user only unless PAGE_DEDUP_GLOBAL is enabled
+PAGE_DEDUP = os.getenv("PAGE_DEDUP", "1") == "1"
+PAGE_DEDUP_GLOBAL = os.getenv("PAGE_DEDUP_GLOBAL", "0") == "1"
+PAGE_INDEX_DB = os.getenv("PAGE_INDEX_DB", "pages.db")
+
+_local = threading.local()
+
+
+def digest(image: Image.Image) -> str:
+    """
+    Exact hash of the binarized page at full resolution.
+
+    Only pages whose every character is the same share a digest, pages of
+    the same template with a different name, amount or page number do not.
+
+    Parameters
+    ----------
+    image : PIL.Image
+        Rasterized page
+    """
+
+    page = image.convert("L").point(lambda pixel: 255 if pixel >= 128 else 0, "1")
+    return hashlib.sha256(f"{page.width}x{page.height}".encode() + page.tobytes()).hexdigest()
+
+
+def _connect() -> sqlite3.Connection:
+    if getattr(_local, "conn", None) is None:
+        conn = sqlite3.connect(PAGE_INDEX_DB, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages (id INTEGER PRIMARY KEY, digest TEXT, user TEXT, text TEXT, created REAL)"
+        )
+        if "digest" not in [row[1] for row in conn.execute("PRAGMA table_info(pages)")]:
+            # rows indexed by perceptual hash only never match
+            conn.execute("ALTER TABLE pages ADD COLUMN digest TEXT")
+        # perceptual hash bands of earlier versions
+        conn.execute("DROP TABLE IF EXISTS page_bands")
+        conn.execute("CREATE INDEX IF NOT EXISTS pages_digest ON pages (digest, user)")
+        conn.execute("CREATE INDEX IF NOT EXISTS pages_user ON pages (user)")
+        conn.commit()
+        _local.conn = conn
+    return _local.conn
+
+
+def lookup(page_digest: str, user: str) -> Optional[str]:
+    """
+    Return the text of a previously extracted identical page, if any.
+
+    Pages of the same user are preferred over pages of other users, which are
+    only considered with PAGE_DEDUP_GLOBAL enabled.
+
+    Parameters
+    ----------
+    page_digest : str
+        digest of the page
+    user : str
+        User the page belongs to
+    """
+
+    conn = _connect()
+    row = conn.execute(
+        "SELECT text FROM pages WHERE digest = ? AND user = ? LIMIT 1", (page_digest, user)
+    ).fetchone()
+    result = "hit_user"
+    if row is None and PAGE_DEDUP_GLOBAL:
+        row = conn.execute(
+            "SELECT text FROM pages WHERE digest = ? LIMIT 1", (page_digest,)
+        ).fetchone()
+        result = "hit_global"
+
+    if row is None:
+        metrics.inc("page_dedup_total", result="miss")
+        return None
+    metrics.inc("page_dedup_total", result=result)
+    return row[0]
+
+
+def add(page_digest: str, user: str, text: str):
+    """
+    Remember the text extracted for a page.
+
+    Parameters
+    ----------
+    page_digest : str
+        digest of the page
+    user : str
+        User the page belongs to
+    text : str
+        Extracted text of the page
+    """
+
+    conn = _connect()
+    with conn:
+        conn.execute(
+            "INSERT INTO pages (digest, user, text, created) VALUES (?, ?, ?, ?)",
+            (page_digest, user, text, time.time()),
+        )
+
+
+def purge(user: str):
+    """
+    Forget the pages of a user, called when their workspace is evicted.
+    """
+
+    conn = _connect()
+    with conn:
+        conn.execute("DELETE FROM pages WHERE user = ?", (user,))
@@ -0,0 +1,138 @@
+import re
+import json
+from typing import Dict, Optional
+
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+
+
+class ParseError(ValueError):
+    """
+    The response of the model is not a JSON object matching the expected schema.
+    """
+
+
+def extract_json(text: str) -> str:
+    """
+    Return the first JSON object in a response, ignoring code fences and any
+    prose around it.
+
+    Parameters
+    ----------
+    text : str
+        Response of the model
+    """
+
+    start = text.find("{")
+    if start == -1:
+        raise ParseError("no JSON object in the response")
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start : i + 1]
+    raise ParseError("the JSON object in the response is not closed")
+
+
+def repair(text: str) -> str:
+    """
+    Fix the defects models commonly produce in JSON, trailing commas and
+    typographic quotes around keys and values.
+    """
+
+    text = text.replace("“", '"').replace("”", '"')
+    return _TRAILING_COMMA.sub(r"\1", text)
+
+
+def skeleton(schema: Dict) -> str:
+    """
+    Describe the keys of a schema as a JSON template for a repair prompt.
+    """
+
+    def template(schema):
+        result = {}
+        for key, expected in schema.items():
+            if isinstance(expected, dict):
+                result[key] = template(expected)
+            elif expected is list:
+                result[key] = "<list>"
+            else:
+                result[key] = "<value>"
+        return result
+
+    return json.dumps(template(schema), indent=4)
+
+
+def validate(value, schema: Dict, path: str = ""):
+    """
+    Check that an object has every key of the schema.
+
+    Parameters
+    ----------
+    value : dict
+        Parsed response
+    schema : dict
+        Every expected key mapped to None for any value, to list or str for
+        a value of that type, or to a nested schema for an object
+    path : str
+        Location of the object in the response, used in error messages
+    """
+
+    if not isinstance(value, dict):
+        raise ParseError(f"{path or 'the response'} is not a JSON object")
+    missing = [key for key in schema if key not in value]
+    if missing:
+        raise ParseError(f"missing keys in {path or 'the response'}: {', '.join(missing)}")
+    for key, expected in schema.items():
+        location = f"{path}.{key}" if path else key
+        if isinstance(expected, dict):
+            validate(value[key], expected, location)
+        elif expected is not None and not isinstance(value[key], expected):
+            raise ParseError(f"{location} is not a {expected.__name__}")
+
+
+def parse(text: str, schema: Optional[Dict] = None) -> Dict:
+    """
+    Parse the JSON object in a response of the model.
+
+    The first JSON object is extracted from the response, repaired if it
+    does not parse and validated against the schema.
+
+    Parameters
+    ----------
+    text : str
+        Response of the model
+    schema : dict
+        Expected keys of the object, see validate
+
+    Raises
+    ------
+    ParseError
+        If the response holds no valid object matching the schema
+    """
+
+    candidate = extract_json(text)
+    try:
+        value = json.loads(candidate, strict=False)
+    except ValueError:
+        try:
+            value = json.loads(repair(candidate), strict=False)
+        except ValueError as e:
+            raise ParseError(f"invalid JSON: {e}") from e
+    if schema is not None:
+        validate(value, schema)
+    return value
@@ -0,0 +1,18 @@
+import os
+
+
+def alive(pid: int) -> bool:
+    """
+    Whether a process with the given pid is still running on this node.
+
+    Used to recognize jobs, rate limit leases and files left behind by
+    worker processes that were killed.
+    """
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
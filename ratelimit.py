@@ -0,0 +1,253 @@
+import os
+import time
+import random
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+import metrics
+import processes
+
+# budget of the Azure OpenAI deployment shared by every worker process on the
+# node, 0 disables the request or token budget
+RATE_LIMIT = os.getenv("RATE_LIMIT", "1") == "1"
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", "ratelimit.db")
+LLM_RPM = float(os.getenv("LLM_RPM", "0"))
+LLM_TPM = float(os.getenv("LLM_TPM", "0"))
+# tokens charged up front for the answer, corrected with the reported usage
+LLM_EXPECTED_OUTPUT_TOKENS = int(os.getenv("LLM_EXPECTED_OUTPUT_TOKENS", "500"))
+# tokens charged for every page image of a vision request
+LLM_IMAGE_TOKENS = int(os.getenv("LLM_IMAGE_TOKENS", "1000"))
+
+# calls in flight across all processes, adapted between these bounds: +1 per
+# round of successful calls, halved on a 429 and reduced when calls are slower
+# than the target latency
+LLM_MIN_CONCURRENCY = float(os.getenv("LLM_MIN_CONCURRENCY", "1"))
+LLM_MAX_CONCURRENCY = float(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+LLM_TARGET_LATENCY = float(os.getenv("LLM_TARGET_LATENCY", "60"))
+_THROTTLE_DECREASE = 0.5
+_LATENCY_DECREASE = 0.9
+# the limit is decreased at most once per congestion window, the recent
+# call latency but at least this many seconds
+_MIN_WINDOW = 1.0
+# seconds between checks of a call waiting for a free slot, doubled up to
+# the maximum so waiting threads do not contend for the database
+_POLL_MIN = 0.05
+_POLL_MAX = 1.0
+
+_local = threading.local()
+
+
+def _connect() -> sqlite3.Connection:
+    if getattr(_local, "conn", None) is None:
+        conn = sqlite3.connect(RATE_LIMIT_DB, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS leases (id INTEGER PRIMARY KEY, pid INTEGER, started REAL)")
+        _local.conn = conn
+    return _local.conn
+
+
+@contextmanager
+def _transaction():
+    # the write lock is taken up front so no other process updates the
+    # buckets between reading and writing them
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _load(conn: sqlite3.Connection) -> dict:
+    now = time.time()
+    state = {
+        "requests": LLM_RPM,
+        "tokens": LLM_TPM,
+        "updated": now,
+        "limit": LLM_MAX_CONCURRENCY,
+        "blocked_until": 0.0,
+        "last_decrease": 0.0,
+        "latency": 0.0,
+    }
+    state.update(dict(conn.execute("SELECT key, value FROM state").fetchall()))
+    # refill the buckets for the time passed, at most one minute of budget
+    elapsed = max(0.0, now - state["updated"])
+    state["requests"] = min(LLM_RPM, state["requests"] + elapsed * LLM_RPM / 60)
+    state["tokens"] = min(LLM_TPM, state["tokens"] + elapsed * LLM_TPM / 60)
+    state["updated"] = now
+    return state
+
+
+def _save(conn: sqlite3.Connection, state: dict):
+    conn.executemany(
+        "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", list(state.items())
+    )
+
+
+def estimate_tokens(messages) -> int:
+    """
+    Tokens a call is charged before it is sent.
+
+    Text is counted as four characters per token, page images at a flat
+    LLM_IMAGE_TOKENS rather than by the size of their base64 payload.
+
+    Parameters
+    ----------
+    messages : str | list
+        Prompt or chat messages sent to the model
+    """
+
+    if isinstance(messages, str):
+        return len(messages) // 4 + LLM_EXPECTED_OUTPUT_TOKENS
+    tokens = LLM_EXPECTED_OUTPUT_TOKENS
+    for message in messages:
+        content = message["content"] if isinstance(message, dict) else message.content
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content:
+            if part["type"] == "image_url":
+                tokens += LLM_IMAGE_TOKENS
+            else:
+                tokens += len(part.get("text", "")) // 4
+    return tokens
+
+
+def _decrease(state: dict, factor: float, now: float) -> bool:
+    # the 429s and slow answers of calls already in flight when the limit
+    # was cut report the same congestion and do not cut it again
+    if now - state["last_decrease"] < max(state["latency"], _MIN_WINDOW):
+        return False
+    state["limit"] = max(LLM_MIN_CONCURRENCY, state["limit"] * factor)
+    state["last_decrease"] = now
+    return True
+
+
+def acquire(tokens: int) -> int:
+    """
+    Wait until a call fits the shared budget and concurrency limit.
+
+    Parameters
+    ----------
+    tokens : int
+        Estimated tokens of the call, see estimate_tokens
+
+    Returns
+    -------
+    The id of the lease, to be passed to release once the call finished.
+    """
+
+    start = time.perf_counter()
+    delay = _POLL_MIN
+    while True:
+        try:
+            lease = _try_acquire(tokens)
+        except sqlite3.OperationalError as e:
+            # the database stayed locked for its whole timeout, keep waiting
+            if "locked" not in str(e):
+                raise
+            lease = None
+        if isinstance(lease, int):
+            metrics.observe("llm_queue_seconds", time.perf_counter() - start)
+            return lease
+        if lease is None:
+            wait = delay * random.uniform(0.5, 1.5)
+            delay = min(delay * 2, _POLL_MAX)
+        else:
+            wait = lease
+        time.sleep(min(wait, _POLL_MAX))
+
+
+def _try_acquire(tokens: int):
+    # the lease id, the seconds until the budget allows the call, or None
+    # while the concurrency limit is reached
+    with _transaction() as conn:
+        # leases of processes that died without releasing them
+        for (pid,) in conn.execute("SELECT DISTINCT pid FROM leases").fetchall():
+            if not processes.alive(pid):
+                conn.execute("DELETE FROM leases WHERE pid = ?", (pid,))
+
+        state = _load(conn)
+        in_flight = conn.execute("SELECT COUNT(*) FROM leases").fetchone()[0]
+        needed = min(tokens, LLM_TPM)
+        now = time.time()
+        if now < state["blocked_until"]:
+            result = float(state["blocked_until"] - now)
+        elif in_flight >= int(state["limit"]):
+            result = None
+        elif LLM_RPM and state["requests"] < 1:
+            result = float((1 - state["requests"]) * 60 / LLM_RPM)
+        elif LLM_TPM and state["tokens"] < needed:
+            result = float((needed - state["tokens"]) * 60 / LLM_TPM)
+        else:
+            if LLM_RPM:
+                state["requests"] -= 1
+            if LLM_TPM:
+                state["tokens"] -= needed
+            result = conn.execute(
+                "INSERT INTO leases (pid, started) VALUES (?, ?)", (os.getpid(), now)
+            ).lastrowid
+        _save(conn, state)
+    return result
+
+
+def release(lease: int, latency: float, estimated_tokens: int, used_tokens: Optional[int] = None):
+    """
+    Return a lease and adapt the concurrency limit to the latency of the call.
+
+    Parameters
+    ----------
+    lease : int
+        Id returned by acquire
+    latency : float
+        Wall time of the call in seconds
+    estimated_tokens : int
+        Tokens charged by acquire
+    used_tokens : int
+        Tokens reported by the model, corrects the charged estimate
+    """
+
+    with _transaction() as conn:
+        conn.execute("DELETE FROM leases WHERE id = ?", (lease,))
+        state = _load(conn)
+        if LLM_TPM and used_tokens:
+            state["tokens"] -= used_tokens - min(estimated_tokens, LLM_TPM)
+        # moving average of the call latency, the length of a congestion window
+        state["latency"] = latency if not state["latency"] else 0.8 * state["latency"] + 0.2 * latency
+        if LLM_TARGET_LATENCY and latency > LLM_TARGET_LATENCY:
+            _decrease(state, _LATENCY_DECREASE, time.time())
+        else:
+            state["limit"] = min(LLM_MAX_CONCURRENCY, state["limit"] + 1 / state["limit"])
+        _save(conn, state)
+
+
+def throttled(retry_after: Optional[float] = None):
+    """
+    Record a 429 response, halve the concurrency limit and hold back new
+    calls of every process until the deployment accepts requests again.
+
+    The limit is halved once per congestion window, further 429s of calls
+    sent before the decrease, including retries of the OpenAI client, only
+    extend the hold.
+
+    Parameters
+    ----------
+    retry_after : float
+        Seconds the deployment asked to wait, from the Retry-After header
+    """
+
+    metrics.inc("llm_throttled_total")
+    with _transaction() as conn:
+        state = _load(conn)
+        now = time.time()
+        decreased = _decrease(state, _THROTTLE_DECREASE, now)
+        if retry_after:
+            state["blocked_until"] = max(state["blocked_until"], now + retry_after)
+        _save(conn, state)
+    if decreased:
+        print(f"LLM throttled, concurrency limit now {state['limit']:.1f}")
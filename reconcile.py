@@ -0,0 +1,193 @@
+import os
+import re
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from typing import Dict, List, Optional
+
+# line items whose qty x unit price differs from the printed amount by more
+# than this are flagged
+AMOUNT_TOLERANCE = Decimal(os.getenv("AMOUNT_TOLERANCE", "0.5"))
+
+# categories the LLM assigns to bill line items, only medical expenses are reimbursed
+CATEGORIES = ["medicine", "consumable", "investigation", "procedure", "room", "non-medical"]
+NON_REIMBURSABLE_CATEGORIES = {"non-medical"}
+
+_CENT = Decimal("0.01")
+
+# Indian policies state limits like "5 Lakhs" or "1.5 crore"
+_MULTIPLIERS = {
+    "thousand": 1000,
+    "k": 1000,
+    "lakh": 100000,
+    "lakhs": 100000,
+    "lac": 100000,
+    "lacs": 100000,
+    "crore": 10000000,
+    "crores": 10000000,
+    "cr": 10000000,
+}
+_AMOUNT = re.compile(
+    r"(-?\d[\d,]*(?:\.\d+)?)\s*(" + "|".join(sorted(_MULTIPLIERS, key=len, reverse=True)) + r")?\b",
+    re.IGNORECASE,
+)
+
+
+def parse_amount(value) -> Optional[Decimal]:
+    """
+    Parse an amount as printed on a bill or policy, e.g. "Rs. 1,200.50",
+    "5 Lakhs" or 50.
+
+    Returns None if the value holds no number.
+    """
+
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float, Decimal)):
+        return Decimal(str(value))
+    match = _AMOUNT.search(str(value))
+    if not match:
+        return None
+    try:
+        amount = Decimal(match.group(1).replace(",", ""))
+    except InvalidOperation:
+        return None
+    if match.group(2):
+        amount *= _MULTIPLIERS[match.group(2).lower()]
+    return amount
+
+
+def _format(value: Decimal) -> str:
+    return f"{value.quantize(_CENT, rounding=ROUND_HALF_UP):,.2f}"
+
+
+def reconcile_items(
+    items: List[Dict],
+    max_reimbursement: Optional[Decimal] = None,
+    co_payment: Optional[Decimal] = None,
+) -> Dict:
+    """
+    Compute the totals of bill line items.
+
+    The amount of an item is its printed amount, or qty x unit price if no
+    amount was printed. Items of a non reimbursable category are deducted,
+    then the co-payment share and the policy cap are applied.
+
+    Parameters
+    ----------
+    items : List[dict]
+        Line items with description, qty, unit-price, amount and category
+    max_reimbursement : Decimal
+        Maximum amount the policy reimburses, no cap if None
+    co_payment : Decimal
+        Percentage of the reimbursable amount paid by the policy holder
+
+    Returns
+    -------
+    The total, reimbursable and non reimbursable amounts, the deductions, and
+    the items whose qty x unit price disagrees with the printed amount.
+    """
+
+    total = Decimal(0)
+    reimbursable = Decimal(0)
+    excluded = []
+    mismatches = []
+    for item in items:
+        qty = parse_amount(item.get("qty"))
+        unit_price = parse_amount(item.get("unit-price"))
+        amount = parse_amount(item.get("amount"))
+        computed = qty * unit_price if qty is not None and unit_price is not None else None
+        if amount is None:
+            amount = computed
+        if amount is None:
+            continue
+        if computed is not None and abs(computed - amount) > AMOUNT_TOLERANCE:
+            mismatches.append(
+                {
+                    "description": item.get("description"),
+                    "qty": str(qty),
+                    "unit-price": str(unit_price),
+                    "computed": _format(computed),
+                    "amount": _format(amount),
+                }
+            )
+
+        total += amount
+        category = str(item.get("category", "")).strip().lower()
+        if category in NON_REIMBURSABLE_CATEGORIES:
+            excluded.append(f"{item.get('description')} ({category}) {_format(amount)}")
+        else:
+            reimbursable += amount
+
+    deductions = []
+    if excluded:
+        deductions.append("Non reimbursable items: " + "; ".join(excluded))
+    approved = reimbursable
+    if co_payment:
+        share = (approved * co_payment / 100).quantize(_CENT, rounding=ROUND_HALF_UP)
+        approved -= share
+        deductions.append(f"Co-payment {co_payment}%: {_format(share)}")
+    if max_reimbursement is not None and approved > max_reimbursement:
+        deductions.append(
+            f"Capped at the maximum reimbursement of {_format(max_reimbursement)}, {_format(approved - max_reimbursement)} not payable"
+        )
+        approved = max_reimbursement
+    for mismatch in mismatches:
+        deductions.append(
+            f"Check {mismatch['description']}: {mismatch['qty']} x {mismatch['unit-price']} = {mismatch['computed']} but the bill shows {mismatch['amount']}"
+        )
+
+    return {
+        "total": total,
+        "reimbursable": approved,
+        "non-reimbursable": total - approved,
+        "deductions": deductions,
+        "mismatches": mismatches,
+    }
+
+
+def reconcile_bill(response: Dict) -> Dict:
+    """
+    Turn the line items extracted from a bill into the bill assessment.
+
+    Parameters
+    ----------
+    response : dict
+        Parsed LLM response with pharmacy-name, items, printed-total,
+        max-reimbursement and co-payment
+
+    Returns
+    -------
+    pharmacy-name, total, non-reimbursible, reimbursible and deductions as
+    shown on the claim assessment page, plus the line items and mismatches.
+    """
+
+    items = response.get("items")
+    if not isinstance(items, list):
+        items = []
+    items = [item for item in items if isinstance(item, dict)]
+    cap = response.get("max-reimbursement")
+    # a limit like "1% of sum insured per day" is a share, not an amount
+    relative_cap = isinstance(cap, str) and "%" in cap
+    result = reconcile_items(
+        items,
+        max_reimbursement=None if relative_cap else parse_amount(cap),
+        co_payment=parse_amount(response.get("co-payment")),
+    )
+
+    deductions = result["deductions"]
+    if relative_cap:
+        deductions.append(f"Check the maximum reimbursement of {cap}, no cap was applied")
+    printed_total = parse_amount(response.get("printed-total"))
+    if printed_total is not None and abs(printed_total - result["total"]) > AMOUNT_TOLERANCE:
+        deductions.append(
+            f"Check the bill total: the line items add up to {_format(result['total'])} but the bill shows {_format(printed_total)}"
+        )
+
+    return {
+        "pharmacy-name": response.get("pharmacy-name", "N/A"),
+        "total": _format(result["total"]),
+        "non-reimbursible": _format(result["non-reimbursable"]),
+        "reimbursible": _format(result["reimbursable"]),
+        "deductions": ". ".join(deductions) if deductions else "No deductions",
+        "items": items,
+        "mismatches": result["mismatches"],
+    }
@@ -0,0 +1,153 @@
+import os
+import re
+import math
+import threading
+from collections import Counter, OrderedDict
+from typing import List
+
+# approximate number of policy tokens placed in a single prompt
+POLICY_TOKEN_BUDGET = int(os.getenv("POLICY_TOKEN_BUDGET", "6000"))
+
+_STOPWORDS = {
+    "a", "an", "and", "any", "are", "as", "at", "be", "by", "for", "from",
+    "in", "is", "it", "of", "on", "or", "the", "that", "this", "to", "was",
+    "what", "when", "whether", "which", "will", "with", "not",
+}
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+_MAX_INDEXES = 32
+
+
+def _tokenize(text: str) -> List[str]:
+    return [t for t in re.findall(r"[a-z0-9]+", text.lower()) if t not in _STOPWORDS]
+
+
+def estimate_tokens(text: str) -> int:
+    # roughly four characters per token for English text
+    return len(text) // 4 + 1
+
+
+class BM25Index:
+    def __init__(self, chunks: List[str], k1: float = 1.5, b: float = 0.75):
+        """
+        Initialize a BM25 index over the chunks of a document.
+
+        Parameters
+        ----------
+        chunks : List[str]
+            Text chunks of the document
+        k1 : float
+            Term frequency saturation
+        b : float
+            Document length normalization
+        """
+
+        self.k1 = k1
+        self.b = b
+        self.terms = [Counter(_tokenize(chunk)) for chunk in chunks]
+        self.lengths = [sum(t.values()) for t in self.terms]
+        self.avg_length = sum(self.lengths) / max(1, len(self.lengths))
+        doc_freq = Counter(term for t in self.terms for term in t)
+        n = len(chunks)
+        self.idf = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for term, df in doc_freq.items()
+        }
+
+    def scores(self, query: str) -> List[float]:
+        """
+        Score every chunk of the document against the query.
+        """
+
+        query_terms = _tokenize(query)
+        scores = []
+        for terms, length in zip(self.terms, self.lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / max(1, self.avg_length))
+            for term in query_terms:
+                tf = terms.get(term, 0)
+                if tf:
+                    score += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            scores.append(score)
+        return scores
+
+
+def get_index(key: str, chunks: List[str]) -> BM25Index:
+    """
+    Return the index of a document, building it once per document.
+
+    Parameters
+    ----------
+    key : str
+        Hash of the document the chunks belong to
+    chunks : List[str]
+        Text chunks of the document
+    """
+
+    with _lock:
+        if key in _indexes:
+            _indexes.move_to_end(key)
+            return _indexes[key]
+    index = BM25Index(chunks)
+    with _lock:
+        _indexes[key] = index
+        while len(_indexes) > _MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def select_chunks(
+    key: str,
+    chunks: List[str],
+    queries: List[str],
+    token_budget: int = POLICY_TOKEN_BUDGET,
+) -> List[str]:
+    """
+    Select the chunks most relevant to the queries under a token budget.
+
+    Every query gets its best matching chunks in turn so that all questions
+    are covered, the selected chunks are returned in document order.
+
+    Parameters
+    ----------
+    key : str
+        Hash of the document the chunks belong to
+    chunks : List[str]
+        Text chunks of the document
+    queries : List[str]
+        Questions the prompt has to answer
+    token_budget : int
+        Maximum estimated number of tokens of the selected chunks
+    """
+
+    if sum(estimate_tokens(chunk) for chunk in chunks) <= token_budget:
+        return chunks
+
+    index = get_index(key, chunks)
+    rankings = []
+    for query in queries:
+        scores = index.scores(query)
+        ranked = sorted(
+            (i for i in range(len(chunks)) if scores[i] > 0),
+            key=lambda i: scores[i],
+            reverse=True,
+        )
+        rankings.append(ranked)
+
+    selected = set()
+    used = 0
+    depth = 0
+    while any(depth < len(r) for r in rankings):
+        for ranked in rankings:
+            if depth >= len(ranked) or ranked[depth] in selected:
+                continue
+            i = ranked[depth]
+            tokens = estimate_tokens(chunks[i])
+            if used + tokens > token_budget:
+                continue
+            selected.add(i)
+            used += tokens
+        depth += 1
+
+    return [chunks[i] for i in sorted(selected)]
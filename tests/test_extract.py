@@ -0,0 +1,19 @@
+import extract
+
+
+def test_split_batch_into_pages():
+    content = "=== Page 1 ===\nPolicy No. 1234\n\n=== Page 2 ===\nSum insured Rs. 5,00,000\n"
+
+    assert extract._split_batch(content, 2) == ["Policy No. 1234", "Sum insured Rs. 5,00,000"]
+
+
+def test_split_batch_with_a_missing_page():
+    content = "=== Page 1 ===\nPolicy No. 1234\n=== Page 3 ===\nNominee details\n"
+
+    assert extract._split_batch(content, 3) is None
+
+
+def test_split_batch_out_of_order():
+    content = "=== Page 2 ===\nSum insured Rs. 5,00,000\n=== Page 1 ===\nPolicy No. 1234\n"
+
+    assert extract._split_batch(content, 2) == ["Policy No. 1234", "Sum insured Rs. 5,00,000"]
@@ -0,0 +1,41 @@
+import pytest
+
+import parsing
+
+
+def test_fenced_answer_with_trailing_comma():
+    text = """```json
+{
+    "reports-tests": "Blood sugar and lipid profile within range",
+}
+```"""
+
+    value = parsing.parse(text, {"reports-tests": None})
+
+    assert value == {"reports-tests": "Blood sugar and lipid profile within range"}
+
+
+def test_prose_before_the_object():
+    text = 'Here are the details of the discharge summary: {"doctor-name": "Dr. Rao", "hospital-name": "City Hospital", "reason": "Dengue"}'
+
+    value = parsing.parse(text, {"doctor-name": None, "hospital-name": None, "reason": None})
+
+    assert value["hospital-name"] == "City Hospital"
+
+
+def test_typographic_quotes():
+    text = "{“reimbursement-sought”: “Rs. 12,000”}"
+
+    value = parsing.parse(text, {"reimbursement-sought": None})
+
+    assert value == {"reimbursement-sought": "Rs. 12,000"}
+
+
+def test_missing_key_raises():
+    with pytest.raises(parsing.ParseError, match="printed-total"):
+        parsing.parse('{"pharmacy-name": "Apollo"}', {"pharmacy-name": None, "printed-total": None})
+
+
+def test_items_of_the_wrong_type_raise():
+    with pytest.raises(parsing.ParseError, match="items"):
+        parsing.parse('{"items": "Paracetamol 50"}', {"items": list})
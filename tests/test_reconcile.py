@@ -0,0 +1,134 @@
+from decimal import Decimal
+
+import pytest
+
+import reconcile
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("Rs. 1,200.50", Decimal("1200.50")),
+        ("INR 5,00,000", Decimal("500000")),
+        ("5 Lakhs", Decimal("500000")),
+        ("Rs.5Lakh", Decimal("500000")),
+        ("10 lacs per year", Decimal("1000000")),
+        ("1.5 crore", Decimal("15000000")),
+        ("3 Cr", Decimal("30000000")),
+        ("5k", Decimal("5000")),
+        ("20%", Decimal("20")),
+        (50, Decimal("50")),
+        (12.5, Decimal("12.5")),
+        ("As per policy", None),
+        (None, None),
+        (True, None),
+    ],
+)
+def test_parse_amount(value, expected):
+    assert reconcile.parse_amount(value) == expected
+
+
+def test_items_are_summed_and_non_medical_items_deducted():
+    result = reconcile.reconcile_items(
+        [
+            {"description": "Paracetamol", "qty": "2", "unit-price": "10.50", "amount": "21.00", "category": "medicine"},
+            {"description": "Syringe", "qty": 3, "unit-price": 5, "category": "consumable"},
+            {"description": "Meal", "amount": "Rs. 150", "category": "Non-Medical"},
+        ]
+    )
+
+    assert result["total"] == Decimal("186.00")
+    assert result["reimbursable"] == Decimal("36.00")
+    assert result["non-reimbursable"] == Decimal("150.00")
+    assert result["mismatches"] == []
+    assert result["deductions"] == ["Non reimbursable items: Meal (non-medical) 150.00"]
+
+
+def test_items_without_an_amount_are_skipped():
+    result = reconcile.reconcile_items([{"description": "Note", "qty": "1"}])
+
+    assert result["total"] == Decimal(0)
+    assert result["deductions"] == []
+
+
+def test_mismatched_line_items_are_flagged():
+    result = reconcile.reconcile_items(
+        [{"description": "Dressing", "qty": "4", "unit-price": "25", "amount": "120", "category": "consumable"}]
+    )
+
+    # the printed amount is kept, the difference is only reported
+    assert result["total"] == Decimal("120")
+    assert result["mismatches"] == [
+        {"description": "Dressing", "qty": "4", "unit-price": "25", "computed": "100.00", "amount": "120.00"}
+    ]
+    assert "Check Dressing: 4 x 25 = 100.00 but the bill shows 120.00" in result["deductions"]
+
+
+def test_differences_within_the_tolerance_are_not_flagged():
+    result = reconcile.reconcile_items(
+        [{"description": "Tablet", "qty": "3", "unit-price": "3.33", "amount": "10", "category": "medicine"}]
+    )
+
+    assert result["mismatches"] == []
+
+
+def test_co_payment_is_applied_before_the_cap():
+    items = [{"description": "Surgery", "amount": "200000", "category": "procedure"}]
+
+    result = reconcile.reconcile_items(items, max_reimbursement=Decimal("150000"), co_payment=Decimal("10"))
+
+    assert result["reimbursable"] == Decimal("150000")
+    assert result["non-reimbursable"] == Decimal("50000")
+    assert result["deductions"][0] == "Co-payment 10%: 20,000.00"
+    assert result["deductions"][1].startswith("Capped at the maximum reimbursement of 150,000.00")
+
+
+def test_cap_stated_in_lakhs_is_not_read_as_rupees():
+    bill = reconcile.reconcile_bill(
+        {
+            "pharmacy-name": "City Pharmacy",
+            "items": [{"description": "Room", "qty": "2", "unit-price": "4000", "amount": "8000", "category": "room"}],
+            "printed-total": "8,000",
+            "max-reimbursement": "5 Lakhs",
+            "co-payment": "0",
+        }
+    )
+
+    assert bill["reimbursible"] == "8,000.00"
+    assert bill["non-reimbursible"] == "0.00"
+    assert bill["deductions"] == "No deductions"
+
+
+def test_cap_stated_as_a_percentage_is_not_applied():
+    bill = reconcile.reconcile_bill(
+        {
+            "items": [{"description": "Room", "qty": "2", "unit-price": "4000", "amount": "8000", "category": "room"}],
+            "max-reimbursement": "1% of sum insured per day",
+        }
+    )
+
+    assert bill["reimbursible"] == "8,000.00"
+    assert bill["non-reimbursible"] == "0.00"
+    assert bill["deductions"] == "Check the maximum reimbursement of 1% of sum insured per day, no cap was applied"
+
+
+def test_bill_total_differing_from_the_items_is_reported():
+    bill = reconcile.reconcile_bill(
+        {
+            "items": [{"description": "Test", "amount": "500", "category": "investigation"}, "not an item"],
+            "printed-total": "Rs. 650",
+        }
+    )
+
+    assert bill["pharmacy-name"] == "N/A"
+    assert bill["total"] == "500.00"
+    assert bill["items"] == [{"description": "Test", "amount": "500", "category": "investigation"}]
+    assert "the line items add up to 500.00 but the bill shows 650.00" in bill["deductions"]
+
+
+def test_missing_items_give_an_empty_bill():
+    bill = reconcile.reconcile_bill({"items": "none"})
+
+    assert bill["total"] == "0.00"
+    assert bill["items"] == []
+    assert bill["deductions"] == "No deductions"
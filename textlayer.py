@@ -0,0 +1,63 @@
+import os
+from typing import Dict, Tuple
+
+import pikepdf
+
+# pages with at least this many characters of embedded text are not rasterized
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", "200"))
+
+
+def _has_fonts(resources, depth: int = 0) -> bool:
+    # text is drawn with fonts, either on the page or inside form XObjects
+    if resources is None:
+        return False
+    if "/Font" in resources and len(resources.Font) > 0:
+        return True
+    if depth < 2 and "/XObject" in resources:
+        for xobject in resources.XObject.values():
+            if xobject.get("/Subtype") == "/Form" and _has_fonts(
+                xobject.get("/Resources"), depth + 1
+            ):
+                return True
+    return False
+
+
+def page_texts(path: str) -> Tuple[int, Dict[int, str]]:
+    """
+    Find the pages of a PDF which carry a usable text layer.
+
+    Pages without fonts are image only and skipped cheaply with pikepdf,
+    the text of the remaining pages is extracted with pdfminer.
+
+    Parameters
+    ----------
+    path : str
+        Path to the PDF
+
+    Returns
+    -------
+    The number of pages and the embedded text of every born-digital page,
+    keyed by the zero based page index.
+    """
+
+    with pikepdf.open(path) as pdf:
+        page_count = len(pdf.pages)
+        candidates = {
+            i for i, page in enumerate(pdf.pages) if _has_fonts(page.resources)
+        }
+
+    texts = {}
+    if candidates:
+        from pdfminer.high_level import extract_pages
+        from pdfminer.layout import LTTextContainer
+
+        layouts = extract_pages(path, page_numbers=candidates)
+        for i, layout in zip(sorted(candidates), layouts):
+            text = "".join(
+                element.get_text()
+                for element in layout
+                if isinstance(element, LTTextContainer)
+            )
+            if len(text.strip()) >= TEXT_LAYER_MIN_CHARS:
+                texts[i] = text
+    return page_count, texts
@@ -0,0 +1,45 @@
+import io
+import os
+import time
+
+# load the document parsing stack before gunicorn forks its workers
+WARMUP = os.getenv("WARMUP", "1") == "1"
+# also load the layout detection model used to partition scanned documents
+WARMUP_LAYOUT_MODEL = os.getenv("WARMUP_LAYOUT_MODEL", "1") == "1"
+
+
+def warmup():
+    """
+    Import the heavy dependencies and load NLTK data and partitioning models once.
+
+    Called in the gunicorn master before the workers are forked, so every
+    worker shares the loaded modules and models copy-on-write instead of
+    loading them on its first request. No LLM or HTTP client is created here,
+    those hold sockets and are created by each worker on first use.
+    """
+
+    if not WARMUP:
+        return
+    start = time.perf_counter()
+
+    import main  # noqa: F401
+    import ocr
+    from langchain_unstructured import UnstructuredLoader  # noqa: F401
+    from pdfminer.high_level import extract_pages  # noqa: F401
+    from unstructured.partition.auto import partition
+
+    ocr.available()
+
+    # partitioning a few sentences loads the NLTK tokenizers and tagger
+    sample = b"Discharge Summary\n\nThe patient was admitted with fever. The patient was discharged in a stable condition."
+    partition(file=io.BytesIO(sample), content_type="text/plain")
+
+    if WARMUP_LAYOUT_MODEL:
+        try:
+            from unstructured_inference.models.base import get_model
+
+            get_model()
+        except Exception as e:
+            print(f"layout model not loaded: {e}")
+
+    print(f"warmup done in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,226 @@
+import os
+import time
+import fcntl
+import shutil
+import tempfile
+import threading
+from typing import Dict, List, Tuple
+
+import metrics
+
+# bytes of uploads and extracted text a user may keep, 0 for no limit
+WORKSPACE_USER_QUOTA_BYTES = int(os.getenv("WORKSPACE_USER_QUOTA_BYTES", str(200 * 1024 * 1024)))
+# bytes of all user workspaces on the node, the least recently used are
+# evicted above it
+WORKSPACE_MAX_BYTES = int(os.getenv("WORKSPACE_MAX_BYTES", str(10 * 1024 * 1024 * 1024)))
+# workspaces unused for longer are evicted, 0 keeps them
+WORKSPACE_MAX_AGE = float(os.getenv("WORKSPACE_MAX_AGE", str(7 * 24 * 3600)))
+# workspaces used more recently are never evicted, so a claim being
+# assessed keeps its documents
+WORKSPACE_MIN_AGE = float(os.getenv("WORKSPACE_MIN_AGE", "3600"))
+# seconds between background evictions, 0 disables the background thread
+WORKSPACE_SWEEP_INTERVAL = float(os.getenv("WORKSPACE_SWEEP_INTERVAL", "600"))
+
+# directories of static/ which are not user workspaces
+_STATIC_DIRS = {"img", "docs"}
+_UPLOAD_PREFIX = ".upload-"
+_SWEEP_LOCK = ".workspace.lock"
+
+_sweeper_pid = None
+
+
+class QuotaExceeded(Exception):
+    """
+    An upload would take the user over WORKSPACE_USER_QUOTA_BYTES.
+    """
+
+
+def user_dirs(user: str) -> List[str]:
+    """
+    Directories holding the uploads and extracted documents of a user.
+    """
+
+    return [f"docs/{user}", f"static/docs/{user}", f"static/{user}"]
+
+
+def _users() -> set:
+    users = set()
+    for root in ["docs", "static/docs", "static"]:
+        try:
+            with os.scandir(root) as entries:
+                users.update(
+                    entry.name
+                    for entry in entries
+                    if entry.is_dir() and not (root == "static" and entry.name in _STATIC_DIRS)
+                )
+        except FileNotFoundError:
+            pass
+    return users
+
+
+def _stat(user: str) -> Tuple[int, float]:
+    # bytes used by the user and when any of their files last changed
+    size = 0
+    last_used = 0.0
+    for directory in user_dirs(user):
+        for root, _, files in os.walk(directory):
+            for name in files:
+                # uploads still being written are counted by their own save
+                if name.startswith(_UPLOAD_PREFIX):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                size += stat.st_size
+                last_used = max(last_used, stat.st_mtime)
+    return size, last_used
+
+
+def usage(user: str) -> int:
+    """
+    Bytes used by the uploads and extracted documents of a user.
+    """
+
+    return _stat(user)[0]
+
+
+def save_upload(file, path: str, user: str) -> str:
+    """
+    Save an uploaded file atomically and enforce the quota of the user.
+
+    The upload is written to a unique temporary file next to ``path`` and
+    renamed over it, so concurrent uploads of the same document never see
+    or leave a partially written file, the last complete upload wins.
+
+    Parameters
+    ----------
+    file : werkzeug.datastructures.FileStorage
+        Uploaded file
+    path : str
+        Destination of the file inside the workspace of the user
+    user : str
+        User who uploaded the file
+
+    Raises
+    ------
+    QuotaExceeded
+        If the upload would take the user over WORKSPACE_USER_QUOTA_BYTES
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=_UPLOAD_PREFIX)
+    os.close(fd)
+    try:
+        file.save(tmp_path)
+        if WORKSPACE_USER_QUOTA_BYTES:
+            # the file being replaced no longer counts once the upload is saved
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            used = usage(user) - replaced + os.path.getsize(tmp_path)
+            if used > WORKSPACE_USER_QUOTA_BYTES:
+                raise QuotaExceeded(
+                    f"Storage limit of {WORKSPACE_USER_QUOTA_BYTES // (1024 * 1024)} MB reached, "
+                    "please remove old claims before uploading more documents"
+                )
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return path
+
+
+def write_text(path: str, text: str):
+    """
+    Write a text file atomically, readers see the old or the new content.
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def remove(user: str):
+    """
+    Delete the uploads, extracted documents, saved sections and indexed
+    pages of a user.
+    """
+
+    import pagehash
+
+    for directory in user_dirs(user):
+        shutil.rmtree(directory, ignore_errors=True)
+    pagehash.purge(user)
+
+
+def sweep(now: float = None) -> Dict[str, int]:
+    """
+    Evict user workspaces unused for WORKSPACE_MAX_AGE, then the least
+    recently used ones until all fit in WORKSPACE_MAX_BYTES.
+
+    Workspaces used within WORKSPACE_MIN_AGE and those of users with
+    documents still being processed are kept. Only one process of the node
+    sweeps at a time, the others return immediately.
+
+    Returns
+    -------
+    The number of evicted workspaces and the bytes left, empty if another
+    process is sweeping.
+    """
+
+    import jobs
+
+    now = now or time.time()
+    with open(_SWEEP_LOCK, "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return {}
+
+        workspaces = sorted(
+            (last_used, size, user)
+            for user in _users()
+            for size, last_used in [_stat(user)]
+        )
+        total = sum(size for _, size, _ in workspaces)
+        evicted = 0
+        for last_used, size, user in workspaces:
+            expired = WORKSPACE_MAX_AGE and now - last_used > WORKSPACE_MAX_AGE
+            if not expired and total <= WORKSPACE_MAX_BYTES:
+                continue
+            if now - last_used < WORKSPACE_MIN_AGE or jobs.pending(user):
+                continue
+            remove(user)
+            total -= size
+            evicted += 1
+            metrics.inc("workspaces_evicted_total", reason="age" if expired else "size")
+        if evicted:
+            print(f"evicted {evicted} workspaces, {total // (1024 * 1024)} MB left")
+        return {"evicted": evicted, "bytes": total}
+
+
+def _sweeper():
+    while True:
+        time.sleep(WORKSPACE_SWEEP_INTERVAL)
+        try:
+            sweep()
+        except Exception as e:
+            print(f"workspace sweep failed: {e}")
+
+
+def start_sweeper():
+    """
+    Start evicting workspaces in a background thread of this process.
+
+    Does nothing if the thread already runs or WORKSPACE_SWEEP_INTERVAL is 0.
+    """
+
+    global _sweeper_pid
+    if not WORKSPACE_SWEEP_INTERVAL or _sweeper_pid == os.getpid():
+        return
+    _sweeper_pid = os.getpid()
+    threading.Thread(target=_sweeper, name="workspace-sweeper", daemon=True).start()